@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""Offline micro-benchmarks for the bridge's hot paths; correctness checks run first."""
+
+import argparse
+import atexit
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+# Keep the bridge's ~/.claude files (routes, session index...) out of the real home
+_HOME = tempfile.mkdtemp(prefix="teleclaude-bench-")
+atexit.register(shutil.rmtree, _HOME, ignore_errors=True)
+os.environ["HOME"] = _HOME
+os.makedirs(os.path.join(_HOME, ".claude"), exist_ok=True)
+
+import bridge  # noqa: E402
+from bench_patterns import make_pane  # noqa: E402
+
+WORDS = ("the handler config request response parse module retry token stream cache "
+         "session pane watcher buffer index record offset latency update").split()
+
+
+def _sentence(rng, n=12):
+    return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+
+# ── Data generators ─────────────────────────────────────────────────
+
+_uuids = itertools.count()
+
+
+def _envelope():
+    """The keys Claude Code writes ahead of "type"/"message" in every record."""
+    n = next(_uuids)
+    return {"parentUuid": f"00000000-0000-0000-0000-{n:012d}", "isSidechain": False,
+            "userType": "external", "cwd": "/home/dev/project",
+            "sessionId": "5f0c8a52-2a77-4d6e-9a51-7b1f3c0e9d21", "version": "2.0.14", "gitBranch": "main"}
+
+
+def user_record(content):
+    """User record in Claude Code's key order: "type" ahead of "message"."""
+    return json.dumps(dict(_envelope(), type="user", message={"role": "user", "content": content},
+                           uuid=f"u-{next(_uuids)}", timestamp="2026-10-17T09:00:00.000Z"))
+
+
+def assistant_record(msg_id, content, usage=None):
+    """Assistant record in Claude Code's key order: "message" (itself typed "message") ahead of "type"."""
+    message = {"id": msg_id, "type": "message", "role": "assistant", "model": "claude-sonnet-4-5",
+               "content": content, "stop_reason": None, "stop_sequence": None,
+               "usage": usage or {"input_tokens": 4, "cache_creation_input_tokens": 1200,
+                                  "cache_read_input_tokens": 18000, "output_tokens": 90}}
+    return json.dumps(dict(_envelope(), message=message, requestId=f"req_{msg_id}", type="assistant",
+                           uuid=f"a-{next(_uuids)}", timestamp="2026-10-17T09:00:05.000Z"))
+
+
+def make_transcript(path, turns=300, tool_result_bytes=1 << 20, big_every=10, seed=0):
+    """A transcript of `turns` assistant turns, one record per content block; every `big_every`th tool_result is huge."""
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write(user_record("Refactor the handlers") + "\n")
+        for i in range(turns):
+            f.write(assistant_record(f"msg_{seed}_{i}", [
+                {"type": "text", "text": " ".join(_sentence(rng) for _ in range(3))}]) + "\n")
+            f.write(assistant_record(f"msg_{seed}_{i}", [
+                {"type": "tool_use", "id": f"t{i}", "name": "Read",
+                 "input": {"file_path": f"/src/pkg/module_{i}.py"}}]) + "\n")
+            size = tool_result_bytes if i % big_every == 0 else 2000
+            f.write(user_record([{"tool_use_id": f"t{i}", "type": "tool_result", "content": "x" * size}]) + "\n")
+    return os.path.getsize(path)
+
+
+def make_history(path, lines=100_000, seed=0):
+    rng = random.Random(seed)
+    t0 = 1_700_000_000_000
+    with open(path, "w") as f:
+        for i in range(lines):
+            f.write(json.dumps({
+                "display": _sentence(rng, 8),
+                "timestamp": t0 + i * 1000 + rng.randint(0, 999),
+                "project": f"/home/dev/project_{rng.randint(0, 40)}",
+            }) + "\n")
+    return os.path.getsize(path)
+
+
+def make_watcher():
+    session = bridge.Session("bench")
+    return bridge.PaneWatcher(session, bridge.FileEvents(mode="poll"))
+
+
+# ── Benchmarks ──────────────────────────────────────────────────────
+# Each returns (callable, info); the callable is what gets timed.
+
+def bench_read_transcript(tmp):
+    path = os.path.join(tmp, "transcript.jsonl")
+    size = make_transcript(path)
+    watcher = make_watcher()
+
+    def run():
+        watcher._transcript_path = path
+        watcher._last_scan = time.time()
+        watcher._tail.seek(0, path)
+        watcher._response.clear()
+        watcher._read_transcript()
+    run()
+    # Every assistant block must come through, or the timing is of a reader that drops records
+    assert (watcher._response.text_count, watcher._response.tool_count) == (300, 300), \
+        (watcher._response.text_count, watcher._response.tool_count)
+    return run, {"bytes": size}
+
+
+def bench_read_transcript_append(tmp):
+    """Steady state: one new assistant record appended to a large transcript."""
+    path = os.path.join(tmp, "transcript_append.jsonl")
+    size = make_transcript(path)
+    record = (assistant_record("msg_done", [
+        {"type": "text", "text": "Done with the handler changes."}]) + "\n").encode()
+    watcher = make_watcher()
+
+    def run():
+        watcher._transcript_path = path
+        watcher._last_scan = time.time()
+        watcher._tail.seek(size, path)
+        with open(path, "r+b") as f:
+            f.seek(size)
+            f.write(record)
+            f.truncate()
+        watcher._read_transcript()
+    run()
+    assert watcher._response.text_count == 1, watcher._response.text_count
+    return run, {"bytes": size}
+
+
+def bench_format_response(_tmp, parts=5000):
+    rng = random.Random(1)
+    buf = bridge.ResponseBuffer()
+    for i in range(parts):
+        if i % 3:
+            buf.append("tool", bridge._tool_summary("Bash", {"command": f"pytest -q tests/test_{i}.py"}))
+        else:
+            buf.append("text", _sentence(rng, 30))
+    watcher = make_watcher()
+    watcher._response = buf
+
+    def run():
+        # As in the live loop: one new part, then a re-render
+        buf.append("text", "Next step.")
+        watcher._format_response()
+        watcher._format_tool_log()
+    return run, {"parts": parts}
+
+
+def _markdown_block(rng, i):
+    """Text block with the markdown Claude writes: emphasis, inline code, a fence."""
+    text = f"**Step {i}.** {_sentence(rng)} Use `config.get({i})` and *retry* once."
+    if i % 4 == 0:
+        text += "\n```python\n" + "\n".join(f"x_{j} = handle(request) < {j}" for j in range(8)) + "\n```"
+    return text
+
+
+def bench_render_html_live(_tmp, parts=5000):
+    """Live edit: one new block, then the HTML tail; earlier blocks come from the cache."""
+    rng = random.Random(4)
+    blocks = [_markdown_block(rng, i) for i in range(parts)]
+    buf = bridge.ResponseBuffer()
+    for text in blocks:
+        buf.append("text", text)
+    buf.render_html()
+    extra = iter(blocks * 100)
+
+    def run():
+        buf.append("text", next(extra) + " ")
+        buf.render_html()
+    return run, {"parts": parts}
+
+
+def bench_render_html_cold(_tmp, blocks=200):
+    """Every block rendered from scratch (what a whole-text converter does per edit)."""
+    rng = random.Random(5)
+    items = [("text", _markdown_block(rng, i)) for i in range(blocks)]
+
+    def run():
+        bridge.MarkdownRenderer().tail(items)
+    return run, {"blocks": blocks}
+
+
+def bench_truncate_html(_tmp):
+    rng = random.Random(6)
+    renderer = bridge.MarkdownRenderer()
+    html = "\n\n".join(renderer.markdown(_markdown_block(rng, i)) for i in range(200))
+    return lambda: renderer.truncate(html), {"bytes": len(html)}
+
+
+def bench_append_parts(_tmp, parts=5000):
+    rng = random.Random(2)
+    items = [("tool" if i % 3 else "text", _sentence(rng, 20)) for i in range(parts)]
+
+    def run():
+        buf = bridge.ResponseBuffer()
+        for ptype, text in items:
+            buf.append(ptype, text)
+    return run, {"parts": parts}
+
+
+def bench_tool_summary(_tmp):
+    rng = random.Random(3)
+    body = "\n".join(_sentence(rng, 14) for _ in range(20_000))   # ~2 MB
+    write = {"file_path": "/home/dev/project/src/big_module.py", "content": body}
+    edit = {"file_path": "/home/dev/project/src/big_module.py",
+            "old_string": body[: len(body) // 2], "new_string": body[len(body) // 2:]}
+    return lambda: (bridge._tool_summary("Write", write), bridge._tool_summary("Edit", edit)), \
+        {"bytes": len(body)}
+
+
+def _pane_variants(prompt):
+    pane = make_pane(200, prompt=prompt)
+    # Distinct content per call so the classifier's last-capture cache doesn't hide the scan
+    return [pane + "\n" * i for i in range(8)]
+
+
+def bench_pane_prompt(_tmp):
+    variants = _pane_variants(True)
+    watcher = make_watcher()
+
+    def run():
+        for v in variants:
+            watcher._pane_text(v)
+            watcher._looks_interactive(v)
+            watcher._parse_options(v)
+    return run, {"lines": 200, "captures": len(variants)}
+
+
+def bench_pane_status(_tmp):
+    variants = _pane_variants(False)
+    watcher = make_watcher()
+
+    def run():
+        for v in variants:
+            watcher._pane_text(v)
+            watcher._looks_interactive(v)
+            watcher._parse_options(v)
+    return run, {"lines": 200, "captures": len(variants)}
+
+
+def bench_recent_sessions_cold(tmp):
+    history = os.path.join(tmp, "history.jsonl")
+    size = make_history(history)
+    cache = os.path.join(tmp, "index.json")
+
+    def run():
+        if os.path.exists(cache):
+            os.remove(cache)
+        bridge.SessionIndex(history, cache).recent(5)
+    return run, {"lines": 100_000, "bytes": size}
+
+
+def bench_recent_sessions_warm(tmp):
+    history = os.path.join(tmp, "history_warm.jsonl")
+    size = make_history(history)
+    index = bridge.SessionIndex(history, os.path.join(tmp, "index_warm.json"))
+    index.recent(5)
+    return lambda: index.recent(5), {"lines": 100_000, "bytes": size}
+
+
+def _search_index(tmp):
+    root = os.path.join(tmp, "projects")
+    for p in range(4):
+        project = os.path.join(root, f"-home-dev-project_{p}")
+        os.makedirs(project, exist_ok=True)
+        for f in range(5):
+            make_transcript(os.path.join(project, f"{p:08d}-0000-0000-0000-{f:012d}.jsonl"),
+                            turns=300, tool_result_bytes=1 << 16, seed=p * 10 + f)
+    index = bridge.TranscriptSearch(os.path.join(tmp, "search.db"), root)
+    index.update()
+    return index
+
+
+def bench_search_query(tmp):
+    index = _search_index(tmp)
+    return lambda: index.search("handler retry"), {"messages": index.stats["messages"]}
+
+
+def bench_search_update_noop(tmp):
+    """Nothing appended: one stat per transcript, no reads."""
+    index = _search_index(tmp)
+    return index.update, {"files": 20}
+
+
+def bench_usage_catch_up(tmp):
+    """First sight of a transcript: /stats totals for its whole history."""
+    path = os.path.join(tmp, "transcript_usage.jsonl")
+    size = make_transcript(path)
+    runs = itertools.count()
+
+    def run():
+        bridge.UsageStats(os.path.join(tmp, f"usage_{next(runs)}.json")).catch_up(path, size)
+    return run, {"bytes": size}
+
+
+BENCHMARKS = {
+    "read_transcript_full": bench_read_transcript,
+    "read_transcript_append": bench_read_transcript_append,
+    "format_response_5k_parts": bench_format_response,
+    "append_5k_parts": bench_append_parts,
+    "render_html_live_5k_parts": bench_render_html_live,
+    "render_html_cold_200": bench_render_html_cold,
+    "truncate_html_200_blocks": bench_truncate_html,
+    "tool_summary_large": bench_tool_summary,
+    "pane_prompt_200_lines": bench_pane_prompt,
+    "pane_status_200_lines": bench_pane_status,
+    "recent_sessions_cold_100k": bench_recent_sessions_cold,
+    "recent_sessions_warm_100k": bench_recent_sessions_warm,
+    "search_query": bench_search_query,
+    "search_update_noop": bench_search_update_noop,
+    "usage_catch_up": bench_usage_catch_up,
+}
+
+
+# ── Checks ──────────────────────────────────────────────────────────
+# Each raises AssertionError on a wrong result.
+
+def check_reader(tmp):
+    """Assistant records come through; tool_results are skipped, even when huge."""
+    path = os.path.join(tmp, "check_reader.jsonl")
+    with open(path, "w") as f:
+        f.write(user_record("Refactor the handlers") + "\n")
+        f.write(assistant_record("msg_1", [{"type": "text", "text": "Reading the handlers."}]) + "\n")
+        f.write(assistant_record("msg_1", [{"type": "tool_use", "id": "t1", "name": "Read",
+                                            "input": {"file_path": "/src/handlers.py"}}]) + "\n")
+        f.write(user_record([{"tool_use_id": "t1", "type": "tool_result", "content": "x" * (1 << 20)}]) + "\n")
+        f.write(assistant_record("msg_2", [{"type": "text", "text": "Done."}]) + "\n")
+    tail = bridge.TranscriptTail(path)
+    tail.CHUNK = 4096   # exercise the skip of a tool_result spanning chunks
+    types = [etype for _offset, etype, _entry in tail.read()]
+    assert types == ["user", "assistant", "assistant", "assistant"], types
+    assert tail.last_human_offset(path) == 0
+
+
+def _write_turn(path):
+    """One finished turn: narration, a tool call and its result, then the answer."""
+    with open(path, "w") as f:
+        f.write(user_record("Fix the retry bug") + "\n")
+        f.write(assistant_record("msg_1", [{"type": "text", "text": "Looking at the retry loop."}]) + "\n")
+        f.write(assistant_record("msg_1", [{"type": "tool_use", "id": "t1", "name": "Edit",
+                                            "input": {"file_path": "/src/retry.py", "old_string": "a",
+                                                      "new_string": "b"}}]) + "\n")
+        f.write(user_record([{"tool_use_id": "t1", "type": "tool_result", "content": "ok"}]) + "\n")
+        f.write(assistant_record("msg_2", [{"type": "text", "text": "Fixed: the **retry** count was off by one."}])
+                + "\n")
+
+
+def check_final_response(tmp):
+    """The Stop hook's final answer, from records read by the watcher or re-read after a restart."""
+    path = os.path.join(tmp, "check_final.jsonl")
+    _write_turn(path)
+    watcher = make_watcher()
+    watcher._transcript_path = path
+    watcher._last_scan = time.time()
+    watcher._tail.seek(0, path)
+    watcher._read_transcript()
+    final = watcher._final_response({"transcript_path": path})
+    assert final and final["text"] == "Fixed: the **retry** count was off by one.", final
+    assert "<b>retry</b>" in final["html"], final
+    # Watcher that never saw the turn start: rebuilt from the last human message
+    assert make_watcher()._final_response({"transcript_path": path}) == final
+
+
+def check_turn_files(tmp):
+    """SEND_FILES sees the edits in assistant records."""
+    path = os.path.join(tmp, "check_files.jsonl")
+    _write_turn(path)
+    files = bridge.TurnFiles()
+    for record in bridge.TranscriptTail(path).read():
+        files.feed(*record)
+    written, patch, edits = files.take()
+    try:
+        assert (written, edits) == ([], 1), (written, edits)
+        with open(patch) as f:
+            assert "+b" in f.read().splitlines()
+    finally:
+        os.remove(patch)
+
+
+def check_search(tmp):
+    """/search finds assistant text, and forgets deleted transcripts."""
+    root = os.path.join(tmp, "check_projects")
+    os.makedirs(os.path.join(root, "-home-dev-project"))
+    path = os.path.join(root, "-home-dev-project", "5f0c8a52-2a77-4d6e-9a51-7b1f3c0e9d21.jsonl")
+    _write_turn(path)
+    index = bridge.TranscriptSearch(os.path.join(tmp, "check_search.db"), root)
+    index.update()
+    hits = index.search("count was off")
+    assert [h[0] for h in hits] == ["5f0c8a52-2a77-4d6e-9a51-7b1f3c0e9d21"], hits
+    assert index.search("retry bug"), "human prompt not indexed"
+    os.remove(path)
+    index.update()
+    assert not index.search("retry"), "deleted transcript still searchable"
+
+
+def check_usage(tmp):
+    """/stats counts each API message once, and nothing twice across restarts."""
+    path = os.path.join(tmp, "check_usage.jsonl")
+    _write_turn(path)
+    store = os.path.join(tmp, "check_usage.json")
+    usage = bridge.UsageStats(store)
+    usage.catch_up(path, os.path.getsize(path))
+    usage.save(force=True)
+    expect = {"turns": 1, "messages": 2, "tools": 1, "input_tokens": 8, "output_tokens": 180,
+              "cache_creation_input_tokens": 2400, "cache_read_input_tokens": 36000}
+    session, _today = usage.totals(Path(path).stem)
+    assert {k: session[k] for k in expect} == expect, session
+    restarted = bridge.UsageStats(store)
+    restarted.catch_up(path, os.path.getsize(path))
+    assert restarted.totals(Path(path).stem)[0]["messages"] == 2
+
+
+CHECKS = [check_reader, check_final_response, check_turn_files, check_search, check_usage]
+
+
+# ── Runner ──────────────────────────────────────────────────────────
+
+def measure(fn, repeat, min_time=0.2):
+    """Per-call seconds over `repeat` runs, each long enough to be timed reliably."""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {"best": min(times), "median": statistics.median(times),
+            "mean": statistics.fmean(times), "number": number, "repeat": repeat}
+
+
+def git_revision():
+    try:
+        r = subprocess.run(["git", "-C", os.path.join(HERE, ".."), "rev-parse", "--short", "HEAD"],
+                           capture_output=True, text=True)
+        return r.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def fmt(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit:2s}"
+    return f"{seconds / 1e-9:8.0f} ns"
+
+
+def compare(results, baseline, threshold):
+    """Print per-benchmark ratios against a baseline. Returns names that regressed."""
+    regressed = []
+    print(f"\nvs {baseline.get('meta', {}).get('revision') or 'baseline'}:")
+    for name, r in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            print(f"  {name:28s} (new)")
+            continue
+        ratio = r["median"] / base["median"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"  {name:28s} {fmt(base['median'])} → {fmt(r['median'])}  {ratio:5.2f}x{flag}")
+        if flag:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--output", help="write results as JSON to this file")
+    ap.add_argument("--compare", help="baseline JSON from an earlier --output run")
+    ap.add_argument("--threshold", type=float, default=1.2,
+                    help="median slowdown vs baseline reported as a regression (default 1.2)")
+    ap.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=_HOME) as tmp:
+        for check in CHECKS:
+            check(tmp)
+        print(f"{len(CHECKS)} checks passed\n")
+        for name, setup in BENCHMARKS.items():
+            if args.filter not in name:
+                continue
+            fn, info = setup(tmp)
+            r = measure(fn, args.repeat)
+            r.update(info)
+            results[name] = r
+            print(f"{name:28s} median {fmt(r['median'])}   best {fmt(r['best'])}   (×{r['number']})")
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "orjson": bridge._json_loads is not bridge.json.loads,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: pane classification on realistic 200-line captures.
+
+Compares PaneClassifier (one pass, shared result) against the previous
+per-caller `any(p in s for p in PATTERNS)` scans.
+
+    python benchmarks/bench_patterns.py [--lines 200] [--number 2000]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bridge  # noqa: E402
+
+SEPARATOR = "─" * 118
+
+CONTENT_LINES = [
+    "⏺ Read(src/server/handlers.py)",
+    "  ⎿  Read 412 lines (ctrl+r to expand)",
+    "⏺ Update(src/server/handlers.py)",
+    "  ⎿  Updated src/server/handlers.py with 12 additions and 3 removals",
+    "       41    def handle(self, request):",
+    "       42 -      return self.route(request)",
+    "       42 +      response = self.route(request)",
+    "       43 +      self.metrics.observe(response)",
+    "⏺ Bash(pytest -q tests/test_handlers.py)",
+    "  ⎿  ........................................................ [100%]",
+    "     58 passed in 3.21s",
+    "⏺ The handler now records a metric for every response. Next I'll update the docs.",
+    "✻ Thinking…",
+    "  The config loader reads environment variables first, then the TOML file.",
+]
+
+SELECT_PROMPT = [
+    SEPARATOR,
+    " Do you want to make this edit to handlers.py?",
+    " ❯ 1. Yes",
+    "   2. Yes, allow all edits during this session (shift+tab)",
+    "   3. No, and tell Claude what to do differently (esc)",
+    "",
+    " Enter to select · ↑/↓ to navigate · Esc to cancel",
+]
+
+STATUS_BAR = [
+    SEPARATOR,
+    "> ",
+    SEPARATOR,
+    "  ⏵⏵ bypass permissions on (shift+tab to cycle)",
+]
+
+
+def make_pane(n_lines=200, prompt=True, seed=0):
+    """A capture like Claude Code's TUI: tool output, blanks, then a prompt or status bar."""
+    rng = random.Random(seed)
+    tail = SELECT_PROMPT if prompt else STATUS_BAR
+    body = []
+    while len(body) < n_lines - len(tail):
+        body.append(rng.choice(CONTENT_LINES) if rng.random() > 0.15 else "")
+    return "\n".join(body + tail)
+
+
+# ── Previous implementation, kept for comparison ────────────────────
+
+LEGACY_INTERACTIVE = [
+    '(y/n)', '(Y/n)', '(yes/no)', 'Do you want', 'Would you like',
+    'approve', 'proceed?', 'continue?', 'Plan mode', 'Enter to select',
+    'Esc to cancel', 'Tab/Arrow keys',
+]
+LEGACY_NOISE = [
+    'bypass permissions', 'shift+tab to cycle', 'esc to interrupt', 'Enter to select',
+    'to navigate', 'Esc to cancel', 'Press Enter to send', '⏵⏵',
+]
+
+
+def legacy_all(content):
+    lines = [l for l in content.split('\n') if l.strip()]
+    interactive = any(p in '\n'.join(lines[-10:]) for p in LEGACY_INTERACTIVE)
+    text = []
+    for l in content.split('\n'):
+        stripped = l.strip()
+        if not stripped or all(c in '─━═┄┅┈┉╌╍' for c in stripped):
+            continue
+        if any(p in stripped for p in LEGACY_NOISE):
+            continue
+        text.append(l)
+    options = []
+    if 'Enter to select' in content:
+        for line in content.split('\n'):
+            m = re.match(r'\s*(?:❯\s*)?(\d+)\.\s+(.+)', line)
+            if m:
+                options.append({'num': int(m.group(1)), 'text': m.group(2).strip()})
+    tail = '\n'.join(content.split('\n')[-5:]).lower()
+    yes_no = any(p in tail for p in ['(y/n)', '(yes/no)', 'yes', ' no'])
+    return interactive, '\n'.join(text[-20:]), options, yes_no
+
+
+def classifier_all(classifier, content):
+    view = classifier.classify(content)
+    return view.interactive, view.text(20), view.options, view.yes_no
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--lines", type=int, default=200)
+    ap.add_argument("--number", type=int, default=2000)
+    args = ap.parse_args()
+
+    panes = [make_pane(args.lines, prompt=p, seed=i) for i, p in enumerate((True, False))]
+    for pane in panes:
+        legacy, new = legacy_all(pane), classifier_all(bridge.PaneClassifier(), pane)
+        assert legacy[0] == new[0] and legacy[2] == new[2], "classification mismatch"
+
+    for pane, label in zip(panes, ("select prompt", "status bar")):
+        classifier = bridge.PaneClassifier()
+        # Fresh content each call: defeat the last-capture cache to time the scan itself
+        variants = [pane + "\n" * (i % 7) for i in range(7)]
+        t_legacy = timeit.timeit(lambda: [legacy_all(v) for v in variants], number=args.number // 7)
+        t_new = timeit.timeit(lambda: [classifier_all(classifier, v) for v in variants],
+                              number=args.number // 7)
+        n = (args.number // 7) * 7
+        print(f"{label:14s} {args.lines} lines: legacy {t_legacy / n * 1e6:8.1f} µs   "
+              f"classifier {t_new / n * 1e6:8.1f} µs   ({t_legacy / t_new:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
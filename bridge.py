@@ -3,26 +3,81 @@
 """Claude Code <-> Telegram Bridge"""
 
 import os
+import base64
+import bisect
+import collections
+import ctypes
+import datetime
+import difflib
+import glob
+import hmac
+import heapq
+import itertools
 import json
 import re
+import http.client
+import select
+import signal
+import socket
+import sqlite3
+import struct
 import subprocess
+import sys
+import tempfile
 import threading
 import time
-import urllib.request
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from pathlib import Path
 
+try:
+    import orjson   # optional, several times faster on large transcript records
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 TMUX_SESSION = os.environ.get("TMUX_SESSION", "claude")
-CHAT_ID_FILE = os.path.expanduser("~/.claude/telegram_chat_id")
-PENDING_FILE = os.path.expanduser("~/.claude/telegram_pending")
+# Comma-separated tmux sessions to bridge, or "*" to follow every session
+TMUX_SESSIONS = os.environ.get("TMUX_SESSIONS", TMUX_SESSION)
+# Per-session files are these paths plus ".<session>"
+CHAT_ID_FILE = os.path.expanduser("~/.claude/telegram_chat_id")   # read once, for migration
 HOOK_RESPONSE_FILE = os.path.expanduser("~/.claude/telegram_hook_response")
+TRANSCRIPT_HINT_FILE = os.path.expanduser("~/.claude/telegram_transcript_path")
+SESSIONS_FILE = os.path.expanduser("~/.claude/telegram_sessions")
+ROUTES_FILE = os.path.expanduser("~/.claude/telegram_routes.json")
+# Hooks send events here; the files above remain the fallback
+HOOK_SOCKET = os.path.expanduser("~/.claude/telegram_bridge.sock")
+STATE_FILE = os.path.expanduser("~/.claude/telegram_state.json")
 HISTORY_FILE = os.path.expanduser("~/.claude/history.jsonl")
+SESSION_INDEX_FILE = os.path.expanduser("~/.claude/telegram_session_index.json")
+PROJECTS_DIR = os.path.expanduser("~/.claude/projects")
+SEARCH_DB = os.path.expanduser("~/.claude/telegram_search.db")
+USAGE_FILE = os.path.expanduser("~/.claude/telegram_usage.json")
+PATTERNS_FILE = os.path.expanduser(os.environ.get("PATTERNS_FILE", "~/.claude/telegram_patterns.json"))
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 PORT = int(os.environ.get("PORT", "8080"))
 PROXY = os.environ.get("TELEGRAM_PROXY", "http://127.0.0.1:7897")
-
-_proxy_handler = urllib.request.ProxyHandler({"https": PROXY, "http": PROXY})
-_opener = urllib.request.build_opener(_proxy_handler)
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", "4"))
+TELEGRAM_HOST = "api.telegram.org"
+WATCH_MODE = os.environ.get("WATCH_MODE", "auto")  # auto (inotify if available) | poll
+TMUX_CONTROL = os.environ.get("TMUX_CONTROL", "1") != "0"
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", "4"))
+UPDATES_MODE = os.environ.get("UPDATES_MODE", "webhook")  # webhook | poll (getUpdates)
+# Telegram sends it as X-Telegram-Bot-Api-Secret-Token (setWebhook secret_token); run.sh sets both
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Bearer token for /metrics and /stats from outside this host (they are always served on loopback)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+UPDATES_OFFSET_FILE = os.path.expanduser("~/.claude/telegram_updates_offset")
+# Send files Claude wrote (and a patch of its edits) as documents after each turn
+SEND_FILES = os.environ.get("SEND_FILES", "0") == "1"
+SEND_FILES_MAX_MB = int(os.environ.get("SEND_FILES_MAX_MB", "20"))   # Bot API allows 50
+# Documents and photos sent to the bot are saved here, relative to the pane's cwd
+RECEIVE_DIR = os.environ.get("RECEIVE_DIR", "telegram_uploads")
+RECEIVE_MAX_MB = int(os.environ.get("RECEIVE_MAX_MB", "20"))   # getFile serves at most 20
+# Accepted MIME types (prefix/* wildcards allowed), or "*" for any
+RECEIVE_TYPES = os.environ.get(
+    "RECEIVE_TYPES", "text/*,image/*,application/pdf,application/json,application/xml,"
+    "application/zip,application/gzip,application/x-tar,application/x-yaml,application/x-sh")
 
 BOT_COMMANDS = [
     {"command": "clear", "description": "Clear conversation"},
@@ -31,26 +86,544 @@ BOT_COMMANDS = [
     {"command": "loop", "description": "Ralph Loop: /loop <prompt>"},
     {"command": "stop", "description": "Interrupt Claude (Escape)"},
     {"command": "status", "description": "Check tmux status"},
+    {"command": "search", "description": "Search all transcripts: /search <terms>"},
+    {"command": "stats", "description": "Token usage: this session and today"},
+    {"command": "sessions", "description": "Pick the tmux session for this chat"},
+    {"command": "session", "description": "Route this chat: /session <name>"},
 ]
 
 BLOCKED_COMMANDS = []
 
 
-def telegram_api(method, data):
-    if not BOT_TOKEN:
-        return None
-    req = urllib.request.Request(
-        f"https://api.telegram.org/bot{BOT_TOKEN}/{method}",
-        data=json.dumps(data).encode(),
-        headers={"Content-Type": "application/json"}
+class Metrics:
+    """Counters, gauges and histograms, rendered in Prometheus text format."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}     # name -> (type, help, fn)
+        self._values = {}   # name -> {label tuple: value | [bucket counts, sum, count]}
+
+    def _declare(self, name, mtype, help, fn=None):
+        self._meta[name] = (mtype, help, fn)
+        self._values.setdefault(name, {})
+
+    def counter(self, name, help):
+        self._declare(name, "counter", help)
+
+    def gauge(self, name, help, fn=None):
+        self._declare(name, "gauge", help, fn)
+        self._values[name].setdefault((), 0)
+
+    def histogram(self, name, help):
+        self._declare(name, "histogram", help)
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter or gauge."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            i = bisect.bisect_left(self.BUCKETS, value)
+            if i < len(self.BUCKETS):
+                h[0][i] += 1  # larger values only show in the +Inf bucket
+            h[1] += value
+            h[2] += 1
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = [*key, *extra]
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        out = []
+        with self._lock:
+            snapshot = {n: {k: (list(v[0]), v[1], v[2]) if isinstance(v, list) else v
+                            for k, v in series.items()}
+                        for n, series in self._values.items()}
+        for name, (mtype, help, fn) in self._meta.items():
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {mtype}")
+            if fn is not None:
+                try:
+                    out.append(f"{name} {fn()}")
+                except Exception:
+                    pass
+                continue
+            for key, v in snapshot[name].items():
+                if mtype != "histogram":
+                    out.append(f"{name}{self._labels(key)} {v}")
+                    continue
+                buckets, total, count = v
+                cumulative = 0
+                for le, n in zip(self.BUCKETS, buckets):
+                    cumulative += n
+                    out.append(f"{name}_bucket{self._labels(key, [('le', le)])} {cumulative}")
+                out.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {count}")
+                out.append(f"{name}_sum{self._labels(key)} {total}")
+                out.append(f"{name}_count{self._labels(key)} {count}")
+        return "\n".join(out) + "\n"
+
+
+_metrics = Metrics()
+_metrics.counter("telegram_api_requests_total", "Bot API requests by method and HTTP status")
+_metrics.counter("telegram_api_errors_total", "Bot API requests that raised or returned non-200")
+_metrics.histogram("telegram_api_request_seconds", "Bot API request latency by method")
+_metrics.counter("tmux_commands_total", "tmux commands by transport (control or subprocess)")
+_metrics.histogram("tmux_command_seconds", "tmux command latency by transport")
+_metrics.histogram("watcher_tick_seconds", "Duration of one PaneWatcher tick")
+_metrics.counter("transcript_read_bytes_total", "Transcript bytes read")
+_metrics.counter("transcript_records_total", "Transcript records parsed, by type")
+_metrics.counter("live_updates_total", "Live message updates submitted, by kind (send or edit)")
+_metrics.histogram("live_update_lag_seconds", "Time from transcript growth to the live message update")
+_metrics.gauge("typing_loops", "Typing indicator threads alive")
+_metrics.counter("updates_duplicate_total", "Redelivered updates dropped before dispatch")
+_metrics.counter("files_sent_total", "Documents uploaded with SEND_FILES")
+_metrics.counter("files_received_total", "Documents and photos saved into a pane's cwd")
+
+
+class TelegramClient:
+    """Keep-alive HTTPS connection pool for the Bot API."""
+
+    IDLE_TIMEOUT = 50    # seconds before an idle connection is considered stale
+    TIMEOUT = 10         # default per-request socket timeout
+    UPLOAD_TIMEOUT = 120
+    UPLOAD_CHUNK = 64 << 10   # also the download read size
+
+    # Errors that mean the kept-alive connection was closed under us
+    STALE_ERRORS = (
+        http.client.RemoteDisconnected,
+        http.client.CannotSendRequest,
+        http.client.BadStatusLine,
+        ConnectionError,
     )
+    # Bot API methods that may be sent twice without a visible effect
+    IDEMPOTENT = ("get", "edit", "delete", "set", "sendChatAction")
+
+    def __init__(self, proxy=PROXY, host=TELEGRAM_HOST, size=TELEGRAM_POOL_SIZE):
+        self.host = host
+        self.size = max(1, size)
+        self._proxy = urllib.parse.urlsplit(proxy) if proxy else None
+        self._idle = []  # [(conn, last_used)], most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self.stats = {"new": 0, "reused": 0, "stale": 0, "retries": 0, "errors": 0}
+
+    def _connect(self):
+        if self._proxy:
+            conn = http.client.HTTPSConnection(
+                self._proxy.hostname, self._proxy.port or 80, timeout=self.TIMEOUT)
+            headers = {}
+            if self._proxy.username:
+                cred = f"{urllib.parse.unquote(self._proxy.username)}:" \
+                       f"{urllib.parse.unquote(self._proxy.password or '')}"
+                headers["Proxy-Authorization"] = "Basic " + base64.b64encode(cred.encode()).decode()
+            conn.set_tunnel(self.host, 443, headers=headers)
+        else:
+            conn = http.client.HTTPSConnection(self.host, 443, timeout=self.TIMEOUT)
+        return conn
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _acquire(self):
+        """Return (conn, reused). Caller must hold a slot."""
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.IDLE_TIMEOUT:
+                    self.stats["reused"] += 1
+                    return conn, True
+                self.stats["stale"] += 1
+                conn.close()
+            self.stats["new"] += 1
+        return self._connect(), False
+
+    def _release(self, conn, keep=True):
+        if keep:
+            with self._lock:
+                self._idle.append((conn, time.time()))
+        else:
+            conn.close()
+
+    def request(self, method, path, body=None, headers=None, timeout=None, sink=None, idempotent=None):
+        """Send one HTTP request over a pooled connection. Returns (status, body bytes)."""
+        if idempotent is None:
+            idempotent = method in ("GET", "HEAD")
+        with self._slots:
+            conn, reused = self._acquire()
+            streamed = False
+            while True:
+                sent = False
+                try:
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout or self.TIMEOUT)
+                    else:
+                        conn.timeout = timeout or self.TIMEOUT
+                    # A callable body is a stream factory: called again on a retry
+                    conn.request(method, path, body=body() if callable(body) else body,
+                                 headers=headers or {})
+                    sent = True
+                    r = conn.getresponse()
+                    if sink and r.status == 200:
+                        streamed = True
+                        while chunk := r.read(self.UPLOAD_CHUNK):
+                            sink(chunk)
+                        payload = b""
+                    else:
+                        payload = r.read()
+                except self.STALE_ERRORS:
+                    conn.close()
+                    # The server may have acted on a written request before dropping the connection
+                    if not reused or streamed or sent and not idempotent:
+                        raise
+                    # Kept-alive connection went away — retry once on a fresh one
+                    self._count("retries")
+                    self._count("new")
+                    conn, reused = self._connect(), False
+                    continue
+                except Exception:
+                    conn.close()
+                    raise
+                self._release(conn, keep=not r.will_close)
+                return r.status, payload
+
+    def call(self, method, data, timeout=None):
+        """POST a Bot API method. Returns (status, decoded JSON or None)."""
+        return self._post(method, json.dumps(data).encode(), {"Content-Type": "application/json"}, timeout)
+
+    def upload(self, method, fields, field, path, filename=None, timeout=None):
+        """POST a Bot API method as multipart/form-data, streaming the file at `path`."""
+        boundary = "teleclaude-" + os.urandom(12).hex()
+        head = b"".join(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+                        for k, v in fields.items() if v is not None)
+        name = (filename or os.path.basename(path)).replace('"', "'").replace("\r", "").replace("\n", "")
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{name}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        size = os.path.getsize(path)
+
+        def body():
+            yield head
+            with open(path, "rb") as f:
+                left = size
+                while left:
+                    chunk = f.read(min(self.UPLOAD_CHUNK, left))
+                    if not chunk:
+                        raise OSError(f"{path} shrank during upload")
+                    left -= len(chunk)
+                    yield chunk
+            yield tail
+
+        return self._post(method, body, {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(head) + size + len(tail)),
+        }, timeout or self.UPLOAD_TIMEOUT)
+
+    def download(self, file_path, dest, max_bytes, timeout=None):
+        """Stream a file from the Bot API to `dest`. Returns the number of bytes written."""
+        part = f"{dest}.part"
+        written = 0
+
+        def sink(chunk):
+            nonlocal written
+            written += len(chunk)
+            if written > max_bytes:
+                raise ValueError(f"larger than {max_bytes >> 20} MB")
+            f.write(chunk)
+
+        try:
+            with open(part, "wb") as f:
+                status, _ = self.request("GET", f"/file/bot{BOT_TOKEN}/{file_path}",
+                                         timeout=timeout or self.UPLOAD_TIMEOUT, sink=sink)
+            if status != 200:
+                raise OSError(f"HTTP {status}")
+            os.replace(part, dest)
+        except BaseException:
+            try:
+                os.remove(part)
+            except OSError:
+                pass
+            raise
+        return written
+
+    def _post(self, method, body, headers, timeout):
+        started = time.monotonic()
+        try:
+            status, payload = self.request("POST", f"/bot{BOT_TOKEN}/{method}", body=body,
+                                           headers=headers, timeout=timeout,
+                                           idempotent=method.startswith(self.IDEMPOTENT))
+        except Exception:
+            _metrics.inc("telegram_api_requests_total", method=method, status="error")
+            _metrics.inc("telegram_api_errors_total", method=method)
+            raise
+        finally:
+            _metrics.observe("telegram_api_request_seconds", time.monotonic() - started, method=method)
+        _metrics.inc("telegram_api_requests_total", method=method, status=status)
+        if status != 200:
+            _metrics.inc("telegram_api_errors_total", method=method)
+        try:
+            return status, json.loads(payload)
+        except ValueError:
+            return status, None
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+_telegram = TelegramClient()
+
+
+def _api_call(method, data):
+    """Call the Bot API and log failures. Returns (status, decoded JSON or None)."""
     try:
-        with _opener.open(req, timeout=10) as r:
-            return json.loads(r.read())
+        status, result = _telegram.call(method, data)
     except Exception as e:
+        _telegram._count("errors")
         print(f"Telegram API {method}: {e}")
+        return 0, None
+    if status != 200:
+        desc = result.get("description", "") if isinstance(result, dict) else ""
+        if status != 429 and "not modified" not in desc:
+            _telegram._count("errors")
+            print(f"Telegram API {method}: HTTP {status} {desc}".rstrip())
+    return status, result
+
+
+def telegram_api(method, data):
+    if not BOT_TOKEN:
+        return None
+    status, result = _api_call(method, data)
+    return result if status == 200 else None
+
+
+# Outbound priorities — lower is sent first within a chat
+PRIORITY_URGENT = 0     # final responses, interactive prompt keyboards
+PRIORITY_NORMAL = 1     # command replies
+PRIORITY_COSMETIC = 2   # live edits, typing indicators, reactions
+
+
+class SendJob:
+    """One queued outbound request, plus fallbacks tried in order if it fails."""
+    __slots__ = ("chat_id", "priority", "seq", "attempts", "callback", "key",
+                 "enqueued", "result", "_done")
+
+    def __init__(self, chat_id, priority, seq, attempts, callback, key):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.attempts = attempts
+        self.callback = callback
+        self.key = key
+        self.enqueued = time.time()
+        self.result = None
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block until the job has been sent (or dropped). Returns the API result."""
+        self._done.wait(timeout)
+        return self.result
+
+
+class SendScheduler:
+    """Single outbound path to Telegram: per-chat queues, rate limits and edit coalescing."""
+
+    CHAT_INTERVAL = float(os.environ.get("SEND_CHAT_INTERVAL", "1.0"))
+    GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "25"))   # requests/second
+    WORKERS = 2
+    SENT_CACHE = 512    # remembered (chat, message) texts for skip-unchanged
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = {}       # chat_id -> [SendJob]
+        self._pending = {}      # coalescing key -> queued SendJob
+        self._busy = set()      # chats with a request in flight
+        self._next_ok = {}      # chat_id -> earliest time of next send
+        self._global_next = 0
+        self._seq = 0
+        self._sent = {}         # (chat_id, message_id) -> last sent signature
+        self.stats = {"queued": 0, "sent": 0, "coalesced": 0, "skipped": 0,
+                      "rate_limited": 0, "failed": 0}
+
+    def start(self):
+        for i in range(self.WORKERS):
+            threading.Thread(target=self._worker, name=f"send-{i}", daemon=True).start()
+
+    @staticmethod
+    def _key(method, data):
+        chat_id = data.get("chat_id")
+        if method in ("editMessageText", "editMessageReplyMarkup"):
+            return (method, chat_id, data.get("message_id"))
+        if method == "sendChatAction":
+            return (method, chat_id, data.get("action"))
         return None
 
+    def submit(self, method, data, priority=PRIORITY_NORMAL, callback=None, fallbacks=()):
+        """Queue a Bot API call. Returns the SendJob; never blocks on the network."""
+        attempts = [(method, data)] + list(fallbacks)
+        key = self._key(method, data)
+        chat_id = data.get("chat_id")
+        with self._cond:
+            job = self._pending.get(key) if key else None
+            if job is not None:
+                # Latest wins: replace the queued call with the newer one
+                job.attempts = attempts
+                job.callback = callback
+                job.priority = min(job.priority, priority)
+                self.stats["coalesced"] += 1
+                return job
+            self._seq += 1
+            job = SendJob(chat_id, priority, self._seq, attempts, callback, key)
+            self._queues.setdefault(chat_id, []).append(job)
+            if key:
+                self._pending[key] = job
+            self.stats["queued"] += 1
+            self._cond.notify()
+        return job
+
+    def cancel(self, job):
+        """Drop a job that has not been sent yet. Returns False once it is in flight or done."""
+        with self._cond:
+            queue = self._queues.get(job.chat_id, [])
+            if job not in queue:
+                return False
+            queue.remove(job)
+            if job.key and self._pending.get(job.key) is job:
+                del self._pending[job.key]
+        job._done.set()
+        return True
+
+    def _count(self, key):
+        with self._cond:
+            self.stats[key] += 1
+
+    def depth(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def _next_job(self):
+        """Pick the best ready job across chats: (job, None) or (None, seconds to wait)."""
+        now = time.time()
+        best, wait = None, None
+        for chat_id, queue in self._queues.items():
+            if not queue or chat_id in self._busy:
+                continue
+            ready_at = self._next_ok.get(chat_id, 0)
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            job = min(queue, key=lambda j: (j.priority, j.seq))
+            if best is None or (job.priority, job.seq) < (best.priority, best.seq):
+                best = job
+        if best is None:
+            return None, wait
+        if self._global_next > now:
+            return None, self._global_next - now
+        self._global_next = max(self._global_next, now) + 1.0 / self.GLOBAL_RATE
+        self._queues[best.chat_id].remove(best)
+        if best.key:
+            self._pending.pop(best.key, None)
+        self._busy.add(best.chat_id)
+        return best, None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job, wait = self._next_job()
+                while job is None:
+                    self._cond.wait(wait)
+                    job, wait = self._next_job()
+            try:
+                result, retry_after = self._execute(job)
+            except Exception as e:
+                print(f"Sender: {e}")
+                result, retry_after = None, None
+            with self._cond:
+                self._busy.discard(job.chat_id)
+                if job.chat_id is not None:
+                    delay = retry_after if retry_after is not None else self.CHAT_INTERVAL
+                    self._next_ok[job.chat_id] = time.time() + delay
+                # Rate limited — put it back unless a newer version superseded it
+                requeue = retry_after is not None and not (job.key and job.key in self._pending)
+                if retry_after is not None:
+                    self.stats["rate_limited"] += 1
+                if requeue:
+                    self._queues.setdefault(job.chat_id, []).append(job)
+                    if job.key:
+                        self._pending[job.key] = job
+                self._cond.notify_all()
+            if requeue:
+                continue
+            job.result = result
+            job._done.set()
+            if job.callback and retry_after is None:
+                try:
+                    job.callback(result)
+                except Exception as e:
+                    print(f"Sender callback: {e}")
+
+    @staticmethod
+    def _signature(data):
+        return (data.get("text"), data.get("parse_mode"),
+                json.dumps(data.get("reply_markup"), sort_keys=True))
+
+    def _execute(self, job):
+        """Run the job's attempts in order. Returns (result, retry_after)."""
+        if not BOT_TOKEN:
+            return None, None
+        for method, data in job.attempts:
+            sent_key = (data.get("chat_id"), data.get("message_id"))
+            if method == "editMessageText":
+                with self._cond:
+                    unchanged = self._sent.get(sent_key) == self._signature(data)
+                if unchanged:
+                    self._count("skipped")
+                    return {"ok": True, "result": {"message_id": data.get("message_id")}}, None
+            status, result = _api_call(method, data)
+            ok = status == 200 and isinstance(result, dict) and result.get("ok")
+            if status == 429:
+                params = (result or {}).get("parameters", {})
+                return None, float(params.get("retry_after", 1))
+            if not status:
+                break   # Transport error: the request may have arrived, a fallback could repeat it
+            desc = (result or {}).get("description", "") if isinstance(result, dict) else ""
+            if status == 400 and "not modified" in desc:
+                ok, result = True, {"ok": True, "result": {"message_id": data.get("message_id")}}
+            if not ok:
+                continue
+            self._count("sent")
+            if method in ("sendMessage", "editMessageText"):
+                msg = result.get("result")
+                msg_id = msg.get("message_id") if isinstance(msg, dict) else data.get("message_id")
+                with self._cond:
+                    self._sent[(data.get("chat_id"), msg_id)] = self._signature(data)
+                    while len(self._sent) > self.SENT_CACHE:
+                        self._sent.pop(next(iter(self._sent)))
+            return result, None
+        self._count("failed")
+        return None, None
+
+
+_outbox = SendScheduler()
+_metrics.gauge("outbox_queue_depth", "Outbound Telegram requests waiting to be sent", fn=_outbox.depth)
+
 
 def setup_bot_commands():
     result = telegram_api("setMyCommands", {"commands": BOT_COMMANDS})
@@ -58,77 +631,784 @@ def setup_bot_commands():
         print("Bot commands registered")
 
 
-def send_typing_loop(chat_id):
-    while os.path.exists(PENDING_FILE):
-        telegram_api("sendChatAction", {"chat_id": chat_id, "action": "typing"})
-        time.sleep(4)
+def send_typing_loop(chat_id, session=None):
+    session = session or default_session()
+    data = {"chat_id": chat_id, "action": "typing"}
+    if session.thread_id:
+        data["message_thread_id"] = session.thread_id
+    _metrics.inc("typing_loops")
+    try:
+        while session.pending:
+            _outbox.submit("sendChatAction", data, PRIORITY_COSMETIC)
+            time.sleep(4)
+    finally:
+        _metrics.inc("typing_loops", -1)
 
 
-def tmux_exists():
-    return subprocess.run(["tmux", "has-session", "-t", TMUX_SESSION], capture_output=True).returncode == 0
+def tmux_quote(arg):
+    """Quote one argument for a tmux command line (control mode)."""
+    if arg and re.fullmatch(r"[\w@%+=:,./-]+", arg):
+        return arg
+    # Single quotes are fully literal; newlines go in double quotes where \n is an escape
+    return "'" + arg.replace("'", "'\\''").replace("\n", "'\"\\n\"'") + "'"
 
 
-def claude_running_in_tmux():
-    """Check if a Claude Code process is running inside the tmux pane."""
+class TmuxControl:
+    """A long-lived `tmux -C` client attached to one session."""
+
+    RECONNECT_DELAY = 5   # seconds between attach attempts
+    TIMEOUT = 5           # seconds to wait for a command reply
+
+    def __init__(self, session):
+        self.session = session
+        self.output_seq = 0
+        self.on_output = None   # called (from the reader thread) on pane output
+        self._proc = None
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._next_attempt = 0
+
+    @property
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def connect(self):
+        """Attach if not attached (rate-limited). Returns True when usable."""
+        if self.alive:
+            return True
+        now = time.time()
+        if now < self._next_attempt:
+            return False
+        self._next_attempt = now + self.RECONNECT_DELAY
+        try:
+            proc = subprocess.Popen(
+                ["tmux", "-C", "attach-session", "-f", "ignore-size", "-t", self.session],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            )
+        except OSError:
+            return False
+        first = self._new_pending()
+        with self._lock:
+            self._proc = proc
+            self._pending.clear()
+            # The attach itself is answered with the first %begin/%end block
+            self._pending.append(first)
+        threading.Thread(target=self._reader, args=(proc,), daemon=True).start()
+        if not first["done"].wait(self.TIMEOUT) or not first["ok"]:
+            self.close()
+            return False
+        print(f"tmux: control client attached to '{self.session}'")
+        return True
+
+    def close(self):
+        with self._lock:
+            proc, self._proc = self._proc, None
+            pending = list(self._pending)
+            self._pending.clear()
+        for p in pending:
+            p["done"].set()
+        if proc and proc.poll() is None:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+            proc.terminate()
+
+    @staticmethod
+    def _new_pending():
+        return {"done": threading.Event(), "ok": False, "lines": []}
+
+    def command(self, *args, timeout=None):
+        """Run one tmux command. Returns (ok, output) or None when not connected."""
+        line = " ".join(tmux_quote(a) for a in args) + "\n"
+        with self._lock:
+            if not self.alive:
+                return None
+            pending = self._new_pending()
+            self._pending.append(pending)
+            try:
+                self._proc.stdin.write(line.encode())
+                self._proc.stdin.flush()
+            except OSError:
+                self._pending.remove(pending)
+                return None
+        if not pending["done"].wait(timeout or self.TIMEOUT):
+            # Lost sync with the client — drop it and fall back
+            self.close()
+            return None
+        if not self.alive and not pending["ok"] and not pending["lines"]:
+            return None
+        return pending["ok"], "\n".join(pending["lines"])
+
+    def _reader(self, proc):
+        block = None   # (begin tag tokens, pending) while inside a reply
+        for raw in proc.stdout:
+            line = raw.decode(errors="replace").rstrip("\n")
+            if block is not None:
+                parts = line.split(" ", 3)
+                if parts[0] in ("%end", "%error") and parts[1:3] == block[0]:
+                    pending = block[1]
+                    pending["ok"] = parts[0] == "%end"
+                    pending["done"].set()
+                    block = None
+                else:
+                    block[1]["lines"].append(line)
+                continue
+            if line.startswith("%begin "):
+                with self._lock:
+                    pending = self._pending.popleft() if self._pending else self._new_pending()
+                block = (line.split(" ", 3)[1:3], pending)
+            elif line.startswith("%output "):
+                self.output_seq += 1
+                if self.on_output:
+                    self.on_output()
+            elif line.startswith("%session-changed "):
+                name = line.split(" ", 2)[2] if line.count(" ") >= 2 else ""
+                if name != self.session:
+                    # Our session went away and tmux moved the client elsewhere
+                    break
+            elif line.startswith("%exit"):
+                break
+        if self._proc is proc:
+            self.close()
+        else:
+            proc.terminate()
+
+
+class BridgeState:
+    """In-memory bridge state with write-behind persistence."""
+
+    FLUSH_INTERVAL = 1.0
+    TRANSIENT = {"pending"}   # a turn in flight does not survive a restart
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = {}           # scope -> {key: value}
+        self._subscribers = []
+        self._dirty = threading.Event()
+        self.stats = {"changes": 0, "flushes": 0}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self._data = {scope: dict(v) for scope, v in data.items() if isinstance(v, dict)}
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def get(self, scope, key, default=None):
+        with self._lock:
+            return self._data.get(scope, {}).get(key, default)
+
+    def set(self, scope, key, value):
+        with self._lock:
+            values = self._data.setdefault(scope, {})
+            old = values.get(key)
+            if key in values and old == value:
+                return
+            values[key] = value
+            self.stats["changes"] += 1
+            subscribers = list(self._subscribers)
+        if key not in self.TRANSIENT:
+            self._dirty.set()
+        for fn in subscribers:
+            try:
+                fn(scope, key, old, value)
+            except Exception as e:
+                print(f"State: {e}")
+
+    def subscribe(self, fn):
+        """Call fn(scope, key, old, new) after every change."""
+        with self._lock:
+            self._subscribers.append(fn)
+
+    def start(self):
+        threading.Thread(target=self._flusher, name="state", daemon=True).start()
+
+    def flush(self):
+        with self._lock:
+            self._dirty.clear()
+            data = {scope: {k: v for k, v in values.items() if k not in self.TRANSIENT}
+                    for scope, values in self._data.items()}
+        try:
+            write_json_atomic(self.path, data)
+            self.stats["flushes"] += 1
+        except OSError as e:
+            print(f"State: {e}")
+
+    def _flusher(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.FLUSH_INTERVAL)   # batch the changes of one burst
+            self.flush()
+
+
+_state = BridgeState()
+
+
+class StateField:
+    """Attribute kept in the bridge state, scoped by the owner's `state_scope`."""
+
+    def __init__(self, key, default=None):
+        self.key = key
+        self.default = default
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return _state.get(obj.state_scope, self.key, self.default)
+
+    def __set__(self, obj, value):
+        _state.set(obj.state_scope, self.key, value)
+
+
+class Session:
+    """One bridged tmux session: its hook files, control client and watcher."""
+
+    chat_id = StateField("chat_id")
+    thread_id = StateField("thread_id")   # forum topic the session's messages go to
+    pending = StateField("pending")       # time a prompt was sent and no Stop seen yet
+
+    def __init__(self, name):
+        self.name = name
+        self.state_scope = name
+        suffix = "." + re.sub(r"[^A-Za-z0-9_-]", "_", name)
+        self.hook_response_file = HOOK_RESPONSE_FILE + suffix
+        self.transcript_hint = TRANSCRIPT_HINT_FILE + suffix
+        self.control = TmuxControl(name)
+        self.watcher = None
+        if self.chat_id is None:
+            self._migrate_chat_id(CHAT_ID_FILE + suffix, CHAT_ID_FILE)
+
+    def _migrate_chat_id(self, *paths):
+        """Adopt the chat id file written by earlier versions."""
+        for path in paths:
+            try:
+                with open(path) as f:
+                    chat_id = f.read().strip()
+            except OSError:
+                continue
+            if chat_id:
+                self.chat_id = chat_id
+                return
+
+    def __repr__(self):
+        return f"Session({self.name!r})"
+
+
+class SessionRegistry:
+    """The tmux sessions this bridge serves, configured or discovered."""
+
+    DISCOVER_INTERVAL = 30
+
+    def __init__(self, spec=TMUX_SESSIONS):
+        self.discover = spec.strip() == "*"
+        names = [] if self.discover else [n.strip() for n in spec.split(",") if n.strip()]
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_discover = 0
+        self._panes = {}    # tmux pane id -> session name
+        for name in names or [TMUX_SESSION]:
+            self._sessions[name] = Session(name)
+        self._default = next(iter(self._sessions))
+
+    def get(self, name):
+        return self._sessions.get(name)
+
+    def default(self):
+        return self._sessions.get(self._default) or next(iter(self._sessions.values()))
+
+    def all(self):
+        return list(self._sessions.values())
+
+    def refresh(self):
+        """In discovery mode, pick up new tmux sessions and drop ended ones. Returns (added, removed)."""
+        now = time.time()
+        if not self.discover or now - self._last_discover < self.DISCOVER_INTERVAL:
+            return [], []
+        self._last_discover = now
+        try:
+            r = subprocess.run(["tmux", "list-sessions", "-F", "#S"], capture_output=True, text=True)
+        except OSError:
+            return [], []
+        if r.returncode != 0:
+            return [], []
+        live = [n for n in r.stdout.split("\n") if n]
+        added, removed = [], []
+        with self._lock:
+            for name in live:
+                if name not in self._sessions:
+                    self._sessions[name] = Session(name)
+                    added.append(self._sessions[name])
+            for name in list(self._sessions):
+                if name not in live and len(self._sessions) > 1:
+                    removed.append(self._sessions.pop(name))
+            if self._default not in self._sessions:
+                self._default = next(iter(self._sessions))
+        if added or removed:
+            self.publish()
+        for sess in removed:
+            sess.control.close()
+        return added, removed
+
+    def for_pane(self, pane_id):
+        """Bridged session owning a tmux pane (e.g. "%3"), or None."""
+        name = self._panes.get(pane_id)
+        if name is None:
+            ok, out = tmux_run("list-panes", "-a", "-F", "#{pane_id} #{session_name}")
+            if ok:
+                self._panes = dict(line.split(" ", 1) for line in out.splitlines() if " " in line)
+            name = self._panes.get(pane_id)
+        return self._sessions.get(name) if name else None
+
+    def publish(self):
+        """Tell the hooks which sessions are bridged."""
+        try:
+            with open(SESSIONS_FILE + ".tmp", "w") as f:
+                f.write("".join(f"{n}\n" for n in self._sessions))
+            os.replace(SESSIONS_FILE + ".tmp", SESSIONS_FILE)
+        except OSError as e:
+            print(f"Sessions file: {e}")
+
+
+_sessions = SessionRegistry()
+
+
+def default_session():
+    return _sessions.default()
+
+
+def tmux_run(*args, session=None):
+    """Run a tmux command, over the session's control client when attached. Returns (ok, stdout)."""
+    ctl = (session or default_session()).control
+    started = time.monotonic()
+    if TMUX_CONTROL and ctl.alive:
+        r = ctl.command(*args)
+        if r is not None:
+            _metrics.inc("tmux_commands_total", transport="control")
+            _metrics.observe("tmux_command_seconds", time.monotonic() - started, transport="control")
+            return r
     try:
-        pane_pid = subprocess.check_output(
-            ["tmux", "display-message", "-t", TMUX_SESSION, "-p", "#{pane_pid}"],
-            stderr=subprocess.DEVNULL
-        ).decode().strip()
+        r = subprocess.run(["tmux", *args], capture_output=True, text=True)
+    except OSError:
+        return False, ""
+    finally:
+        _metrics.inc("tmux_commands_total", transport="subprocess")
+        _metrics.observe("tmux_command_seconds", time.monotonic() - started, transport="subprocess")
+    return r.returncode == 0, r.stdout
+
+
+def tmux_exists(session=None):
+    session = session or default_session()
+    if TMUX_CONTROL and session.control.alive:
+        return True
+    ok, _ = tmux_run("has-session", "-t", session.name, session=session)
+    if ok and TMUX_CONTROL:
+        session.control.connect()
+    return ok
+
+
+def tmux_capture(*extra, session=None):
+    session = session or default_session()
+    ok, out = tmux_run("capture-pane", "-t", session.name, "-p", *extra, session=session)
+    return out if ok else ""
+
+
+class PaneProcesses:
+    """What runs in a pane, read from /proc."""
+
+    __slots__ = ("pane_pid", "at_shell", "claude_pid", "claude_uptime", "claude_foreground")
+
+    def __init__(self, pane_pid, at_shell=False, claude_pid=None, claude_uptime=None,
+                 claude_foreground=False):
+        self.pane_pid = pane_pid
+        self.at_shell = at_shell                    # the pane's shell owns the terminal
+        self.claude_pid = claude_pid                # shallowest descendant that is Claude (see _is_claude)
+        self.claude_uptime = claude_uptime          # seconds
+        self.claude_foreground = claude_foreground  # Claude's process group owns the terminal
+
+    @property
+    def claude_running(self):
+        return self.claude_pid is not None
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class ProcessInspector:
+    """Finds the Claude process in each pane by reading /proc (cached)."""
+
+    TTL = 2.0
+
+    def __init__(self, proc="/proc"):
+        self.proc = proc
+        self.procfs = os.path.isdir(os.path.join(proc, "self"))
+        self._lock = threading.Lock()
+        self._panes = {}      # session name → pane pid
+        self._cache = {}      # session name → (checked, PaneProcesses)
+        self.stats = {"hits": 0, "inspections": 0, "pane_lookups": 0}
+        self._clk_tck = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def inspect(self, session=None, max_age=None):
+        """PaneProcesses for the session's pane, or None when the pane is gone."""
+        session = session or default_session()
+        max_age = self.TTL if max_age is None else max_age
+        now = time.monotonic()
+        with self._lock:
+            pane_pid = self._panes.get(session.name)
+            cached = self._cache.get(session.name)
+        if pane_pid and not self._alive(pane_pid):
+            pane_pid = cached = None
+        if cached and now - cached[0] <= max_age:
+            self.stats["hits"] += 1
+            return cached[1]
         if not pane_pid:
+            pane_pid = self._pane_pid(session)
+            if not pane_pid:
+                return None
+        self.stats["inspections"] += 1
+        result = self._inspect(pane_pid) if self.procfs else self._inspect_pgrep(pane_pid)
+        with self._lock:
+            self._panes[session.name] = pane_pid
+            self._cache[session.name] = (now, result)
+        return result
+
+    def _pane_pid(self, session):
+        self.stats["pane_lookups"] += 1
+        ok, out = tmux_run("display-message", "-t", session.name, "-p", "#{pane_pid}", session=session)
+        try:
+            return int(out.strip()) if ok else None
+        except ValueError:
+            return None
+
+    def _alive(self, pid):
+        if self.procfs:
+            return os.path.exists(f"{self.proc}/{pid}")
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except OSError:
+            return True
+
+    def _read(self, pid, name):
+        try:
+            with open(f"{self.proc}/{pid}/{name}", "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _stat(self, pid):
+        """Fields after "(comm)": [state, ppid, pgrp, session, tty_nr, tpgid, ...]."""
+        raw = self._read(pid, "stat")
+        return raw.rsplit(b")", 1)[1].split() if raw else None
+
+    def _scan(self):
+        """{ppid: [pids]} from one pass over every process."""
+        tree = collections.defaultdict(list)
+        for name in os.listdir(self.proc):
+            if name.isdigit():
+                st = self._stat(name)
+                if st:
+                    tree[int(st[1])].append(int(name))
+        return tree
+
+    def _inspect(self, pane_pid):
+        st = self._stat(pane_pid)
+        result = PaneProcesses(pane_pid, at_shell=bool(st) and int(st[5]) == pane_pid)
+        tree = None     # only built when the kernel has no children files
+        level = [pane_pid] if st else []
+        # Breadth-first, so a wrapper's `claude` wins over Claude's own children
+        while level:
+            nxt = []
+            for pid in level:
+                kids = self._read(pid, f"task/{pid}/children")
+                if kids is not None:
+                    kids = [int(c) for c in kids.split()]
+                else:
+                    if tree is None:
+                        tree = self._scan()
+                    kids = tree.get(pid, ())
+                for child in kids:
+                    if self._is_claude(self._read(child, "cmdline") or b""):
+                        self._describe_claude(result, child)
+                        return result
+                    nxt.append(child)
+            level = nxt
+        return result
+
+    @staticmethod
+    def _is_claude(cmdline):
+        """True for `claude …` or the `claude` script run by node/bun, not `tail -f ~/.claude/…`."""
+        argv = cmdline.split(b"\0")
+        name = os.path.basename(argv[0])
+        if name in (b"node", b"nodejs", b"bun") and len(argv) > 1:
+            name = b"claude" if argv[1].endswith(b"/claude-code/cli.js") else os.path.basename(argv[1])
+        return name == b"claude"
+
+    def _describe_claude(self, result, pid):
+        result.claude_pid = pid
+        st = self._stat(pid)
+        if not st:
+            return
+        result.claude_foreground = int(st[5]) == int(st[2])
+        try:
+            with open(f"{self.proc}/uptime") as f:
+                since_boot = float(f.read().split()[0])
+            # starttime (field 22) is in clock ticks since boot
+            result.claude_uptime = round(since_boot - int(st[19]) / self._clk_tck, 1)
+        except (OSError, ValueError, IndexError):
+            pass
+
+    def shell_waiting(self, session):
+        """True when the pane's shell owns the terminal and sleeps reading input; None without /proc."""
+        info = self.inspect(session, max_age=0)
+        if not info or not self.procfs:
+            return None
+        st = self._stat(info.pane_pid)
+        return info.at_shell and bool(st) and st[0] == b"S"
+
+    def _inspect_pgrep(self, pane_pid):
+        try:
+            r = subprocess.run(["pgrep", "-P", str(pane_pid), "-f", "^([^ ]*/)?((node|nodejs|bun) ([^ ]*/)?)?claude( |$)"],
+                               capture_output=True, text=True)
+        except FileNotFoundError:
+            return PaneProcesses(pane_pid)
+        pids = r.stdout.split()
+        return PaneProcesses(pane_pid, at_shell=not pids, claude_pid=int(pids[0]) if pids else None)
+
+
+_processes = ProcessInspector()
+
+
+def claude_running_in_tmux(session=None, max_age=None):
+    """Check if a Claude Code process is running inside the tmux pane."""
+    info = _processes.inspect(session, max_age)
+    return bool(info and info.claude_running)
+
+
+def tmux_send(text, literal=True, session=None):
+    session = session or default_session()
+    args = ["send-keys", "-t", session.name]
+    if literal:
+        args.append("-l")
+    args.append(text)
+    tmux_run(*args, session=session)
+
+
+def tmux_send_keys(*keys, session=None):
+    """Send several named keys (e.g. "Down", "Enter") in one tmux command."""
+    if keys:
+        session = session or default_session()
+        tmux_run("send-keys", "-t", session.name, *keys, session=session)
+
+
+def tmux_send_enter(session=None):
+    tmux_send_keys("Enter", session=session)
+
+
+def tmux_send_escape(session=None):
+    tmux_send_keys("Escape", session=session)
+
+
+def write_json_atomic(path, data):
+    """Write JSON via a temp file and rename, so readers never see partial data."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def session_label(session, text, html=False):
+    """Prefix `text` with the session's name when the bridge serves more than one."""
+    if len(_sessions.all()) < 2:
+        return text
+    name = session.name.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;") if html else session.name
+    return f"[{name}] {text}"
+
+
+class SessionRouter:
+    """Maps incoming Telegram messages to bridged sessions."""
+
+    REMEMBER = 2048  # recent (chat, message_id) -> session entries
+
+    def __init__(self, registry, path=ROUTES_FILE):
+        self.registry = registry
+        self.path = path
+        self._lock = threading.Lock()
+        self._messages = collections.OrderedDict()
+        self._chats = {}
+        self._topics = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self._chats = dict(data.get("chats", {}))
+            self._topics = dict(data.get("topics", {}))
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def resolve(self, chat_id, thread_id=None, message_id=None):
+        """Session for a message in `chat_id`/`thread_id` replying to bot message `message_id`."""
+        with self._lock:
+            names = [self._messages.get((str(chat_id), message_id)) if message_id else None,
+                     self._topics.get(f"{chat_id}:{thread_id}") if thread_id else None,
+                     self._chats.get(str(chat_id))]
+        for name in names:
+            session = name and self.registry.get(name)
+            if session:
+                return session
+        return self.registry.default()
+
+    def bind(self, chat_id, session, thread_id=None):
+        """Route the chat (or just its topic) to `session` from now on."""
+        with self._lock:
+            if thread_id:
+                self._topics[f"{chat_id}:{thread_id}"] = session.name
+            else:
+                self._chats[str(chat_id)] = session.name
+            data = {"chats": dict(self._chats), "topics": dict(self._topics)}
+        try:
+            write_json_atomic(self.path, data)
+        except OSError as e:
+            print(f"Routes: {e}")
+
+    def remember(self, chat_id, message_id, session):
+        if not chat_id or not message_id:
+            return
+        with self._lock:
+            self._messages[(str(chat_id), message_id)] = session.name
+            self._messages.move_to_end((str(chat_id), message_id))
+            while len(self._messages) > self.REMEMBER:
+                self._messages.popitem(last=False)
+
+
+_router = SessionRouter(_sessions)
+
+
+class SessionIndex:
+    """Persistent, incrementally maintained index behind /resume."""
+
+    KEEP = 50
+    PROJECT_TTL = 60
+
+    def __init__(self, history=HISTORY_FILE, cache=SESSION_INDEX_FILE):
+        self.history = history
+        self.cache = cache
+        self._lock = threading.Lock()
+        self._state = None
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self.cache) as f:
+                state = json.load(f)
+            if not isinstance(state, dict) or "offset" not in state:
+                raise ValueError
+        except (OSError, ValueError):
+            state = {"offset": 0, "ino": None, "top": [], "projects": {}}
+        self._state = state
+
+    def _save(self):
+        try:
+            write_json_atomic(self.cache, self._state)
+        except OSError as e:
+            print(f"Session index: {e}")
+
+    def _refresh(self):
+        """Fold newly appended history lines into the top-k. Returns True if anything changed."""
+        st = os.stat(self.history)
+        state = self._state
+        if st.st_ino != state["ino"] or st.st_size < state["offset"]:
+            state.update(offset=0, ino=st.st_ino, top=[])
+        if st.st_size == state["offset"]:
             return False
-        # Check for claude child process
-        result = subprocess.run(
-            ["pgrep", "-P", pane_pid, "-f", "claude"],
-            capture_output=True
-        )
-        return result.returncode == 0
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+        heap = [(e.get("timestamp", 0), i, e) for i, e in enumerate(state["top"])]
+        heapq.heapify(heap)
+        seq = len(heap)
+        with open(self.history, "rb") as f:
+            f.seek(state["offset"])
+            data = f.read(st.st_size - state["offset"])
+        end = data.rfind(b"\n") + 1   # only complete lines
+        for line in data[:end].splitlines():
+            try:
+                entry = _json_loads(line)
+            except ValueError:
+                continue
+            if not isinstance(entry, dict):
+                continue
+            seq += 1
+            item = (entry.get("timestamp", 0), seq, entry)
+            if len(heap) < self.KEEP:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+        state["offset"] += end
+        state["top"] = [e for _, _, e in sorted(heap, key=lambda x: (-x[0], x[1]))]
+        return True
 
+    def recent(self, limit=5):
+        with self._lock:
+            if self._state is None:
+                self._load()
+            try:
+                if self._refresh():
+                    self._save()
+            except OSError:
+                return []
+            return self._state["top"][:limit]
 
-def tmux_send(text, literal=True):
-    cmd = ["tmux", "send-keys", "-t", TMUX_SESSION]
-    if literal:
-        cmd.append("-l")
-    cmd.append(text)
-    subprocess.run(cmd)
+    def session_ids(self, project_paths):
+        """Newest transcript id for each project directory (None if it has none), saving the cache once."""
+        now = time.time()
+        with self._lock:
+            if self._state is None:
+                self._load()
+            self._dirty = False
+            ids = [self._session_id(path, now) for path in project_paths]
+            if self._dirty:
+                self._save()
+        return ids
 
+    def session_id(self, project_path):
+        """Newest transcript id for a project directory."""
+        return self.session_ids([project_path])[0]
 
-def tmux_send_enter():
-    subprocess.run(["tmux", "send-keys", "-t", TMUX_SESSION, "Enter"])
+    def _session_id(self, project_path, now):
+        encoded = project_path.replace("/", "-").lstrip("-")
+        projects = self._state["projects"]
+        for prefix in [f"-{encoded}", encoded]:
+            project_dir = Path.home() / ".claude" / "projects" / prefix
+            try:
+                mtime = project_dir.stat().st_mtime
+            except OSError:
+                continue
+            cached = projects.get(str(project_dir))
+            if cached and cached["mtime"] == mtime and now - cached["checked"] < self.PROJECT_TTL:
+                if cached["stem"]:
+                    return cached["stem"]
+                continue
+            jsonls = list(project_dir.glob("*.jsonl"))
+            stem = max(jsonls, key=lambda p: p.stat().st_mtime).stem if jsonls else None
+            projects[str(project_dir)] = {"mtime": mtime, "checked": now, "stem": stem}
+            self._dirty = True
+            if stem:
+                return stem
+        return None
 
 
-def tmux_send_escape():
-    subprocess.run(["tmux", "send-keys", "-t", TMUX_SESSION, "Escape"])
+_session_index = SessionIndex()
 
 
 def get_recent_sessions(limit=5):
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    sessions = []
-    try:
-        with open(HISTORY_FILE) as f:
-            for line in f:
-                try:
-                    sessions.append(json.loads(line.strip()))
-                except:
-                    continue
-    except:
-        return []
-    sessions.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    return sessions[:limit]
+    return _session_index.recent(limit)
 
 
 def get_session_id(project_path):
-    encoded = project_path.replace("/", "-").lstrip("-")
-    for prefix in [f"-{encoded}", encoded]:
-        project_dir = Path.home() / ".claude" / "projects" / prefix
-        if project_dir.exists():
-            jsonls = list(project_dir.glob("*.jsonl"))
-            if jsonls:
-                return max(jsonls, key=lambda p: p.stat().st_mtime).stem
-    return None
+    return _session_index.session_id(project_path)
+
+
+def get_session_ids(project_paths):
+    return _session_index.session_ids(project_paths)
 
 
 def _tool_summary(name, inp):
@@ -193,15 +1473,42 @@ def _tool_summary(name, inp):
         return f"🔧 {name}" + (f" → {hint}" if hint else "")
 
 
-class PaneWatcher(threading.Thread):
-    """Monitors Claude's transcript for live updates and tmux for interactive prompts."""
-    daemon = True
+class PaneView:
+    """A pane capture classified line by line. Shared by every caller for one capture."""
 
-    POLL_INTERVAL = 2    # seconds between checks
-    LIVE_INTERVAL = 3    # seconds between live message updates
-    IDLE_THRESHOLD = 4   # seconds of tmux stability for interactive detection
-    COOLDOWN = 15        # minimum seconds between interactive prompt forwards
+    __slots__ = ("lines", "flags", "options", "cursor", "interactive", "yes_no")
+
+    def __init__(self, lines, flags, options, cursor, interactive, yes_no):
+        self.lines = lines
+        self.flags = flags              # per-line PaneClassifier bit flags
+        self.options = options          # [{'num', 'text'}] when a selection list is shown
+        self.cursor = cursor            # option number under ❯, or None
+        self.interactive = interactive  # prompt pattern in the last 10 non-empty lines
+        self.yes_no = yes_no            # yes/no wording in the last 5 lines
+
+    def text(self, max_lines=None):
+        """Content lines (no blanks, separators or TUI chrome), last `max_lines` of them."""
+        skip = PaneClassifier.SEPARATOR | PaneClassifier.NOISE
+        out = []
+        # Walk back from the end so only the displayed tail is visited
+        for i in range(len(self.lines) - 1, -1, -1):
+            if max_lines and len(out) >= max_lines:
+                break
+            if not self.flags[i] & skip and self.lines[i].strip():
+                out.append(self.lines[i])
+        return '\n'.join(reversed(out))
+
+
+class PaneClassifier:
+    """Single-pass classifier for tmux pane captures."""
+
+    NOISE = 1
+    INTERACTIVE = 2
+    YES_NO = 4
+    SELECT = 8
+    SEPARATOR = 16
 
+    # Matched case-sensitively
     INTERACTIVE_PATTERNS = [
         '(y/n)', '(Y/n)', '(yes/no)',
         'Do you want', 'Would you like',
@@ -212,10 +1519,10 @@ class PaneWatcher(threading.Thread):
         'Tab/Arrow keys',
     ]
 
-    # Lines matching any of these patterns are TUI chrome, not content
+    # Lines matching any of these patterns are TUI chrome, not content (case-insensitive)
     NOISE_PATTERNS = [
         'bypass permissions',
-        'shift+tab to cycle',
+        'shift+tab',
         'esc to interrupt',
         'Enter to select',
         'to navigate',
@@ -224,63 +1531,1089 @@ class PaneWatcher(threading.Thread):
         '⏵⏵',
     ]
 
+    YES_NO_PATTERNS = ['(y/n)', '(yes/no)', 'yes', ' no']    # case-insensitive
+
+    SEPARATOR_CHARS = '─━═┄┅┈┉╌╍'
+    # Anchored on the preceding newline (literal prefix → fast scan)
+    OPTION_RE = re.compile(r'\n[^\S\n]*(❯[^\S\n]*)?(\d+)\.[^\S\n]+([^\n]+)')
+
+    def __init__(self):
+        self._rules = {
+            self.INTERACTIVE: list(self.INTERACTIVE_PATTERNS),
+            self.NOISE: list(self.NOISE_PATTERNS),
+            self.YES_NO: list(self.YES_NO_PATTERNS),
+        }
+        self._last = (None, None)
+        self._compile()
+
+    def extend(self, interactive=(), noise=(), yes_no=()):
+        self._rules[self.INTERACTIVE] += list(interactive)
+        self._rules[self.NOISE] += list(noise)
+        self._rules[self.YES_NO] += list(yes_no)
+        self._compile()
+
+    def load(self, path=PATTERNS_FILE):
+        """Add user patterns from a JSON file, if present."""
+        try:
+            with open(path) as f:
+                extra = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Patterns {path}: {e}")
+            return
+        if not isinstance(extra, dict):
+            print(f"Patterns {path}: expected an object with interactive/noise/yes_no lists, ignored")
+            return
+        lists = []
+        for key in ("interactive", "noise", "yes_no"):
+            patterns = extra.get(key, [])
+            if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+                print(f"Patterns {path}: {key!r} is not a list of strings, ignored")
+                patterns = []
+            lists.append(patterns)
+        self.extend(*lists)
+        print(f"Patterns: loaded {path}")
+
+    def _compile(self):
+        """Build [(lowercased text, flags if present in any case, {exact text: flags})]."""
+        table = {}
+        for kind, patterns in self._rules.items():
+            for p in patterns:
+                entry = table.setdefault(p.lower(), [0, {}])
+                if kind == self.INTERACTIVE:
+                    entry[1][p] = entry[1].get(p, 0) | kind
+                else:
+                    entry[0] |= kind
+        table.setdefault('enter to select', [0, {}])[0] |= self.SELECT
+        self._table = [(low, ci, tuple(exact.items())) for low, (ci, exact) in table.items()]
+        self._last = (None, None)
+
+    def classify(self, content):
+        """Classify a capture. The last result is cached, so repeated calls are free."""
+        if content == self._last[0]:
+            return self._last[1]
+        low = content.lower()
+        lines = content.split('\n')
+        starts = list(itertools.accumulate((len(l) + 1 for l in lines), initial=0))
+        flags = [0] * len(lines)
+        # Only patterns that occur anywhere are located, line by line via bisect
+        for p, ci, exact in self._table:
+            pos = low.find(p)
+            while pos >= 0:
+                i = bisect.bisect_right(starts, pos) - 1
+                flags[i] |= ci
+                for e, cs in exact:
+                    if e in lines[i]:
+                        flags[i] |= cs
+                pos = low.find(p, starts[i + 1])
+        sep = self.SEPARATOR_CHARS
+        for ch in sep:
+            pos = content.find(ch)
+            while pos >= 0:
+                i = bisect.bisect_right(starts, pos) - 1
+                if not lines[i].strip().strip(sep):
+                    flags[i] |= self.SEPARATOR
+                pos = content.find(ch, starts[i + 1])
+        # Numbered options only matter while a selection list is on screen
+        options, cursor = [], None
+        if 'enter to select' in low or '❯' in content:
+            for m in self.OPTION_RE.finditer('\n' + content):
+                options.append({'num': int(m.group(2)), 'text': m.group(3).strip()})
+                if m.group(1) and cursor is None:
+                    cursor = int(m.group(2))
+        # Interactive: any prompt pattern among the last 10 non-empty lines
+        interactive, seen = False, 0
+        for i in range(len(lines) - 1, -1, -1):
+            if seen == 10:
+                break
+            if lines[i].strip():
+                seen += 1
+                interactive = interactive or bool(flags[i] & self.INTERACTIVE)
+        view = PaneView(
+            lines, flags,
+            options if 'enter to select' in low else [],
+            cursor,
+            interactive,
+            any(f & self.YES_NO for f in flags[-5:]),
+        )
+        self._last = (content, view)
+        return view
+
+
+_pane_classifier = PaneClassifier()
+
+
+class ResponseBuffer:
+    """Rolling render buffer for one response cycle."""
+
+    def __init__(self, limit=4000):
+        self.limit = limit
+        self.tool_limit = limit - 100    # room for headers and the summary line
+        self.tool_count = 0
+        self.text_count = 0
+        self._parts = collections.deque()    # (ptype, text)
+        self._chars = -1                     # len("\n".join(parts))
+        self._tools = collections.deque()
+        self._tool_chars = -1
+        self._rendered = None
+        self._rendered_html = None
+        self._tool_log = None
+
+    def __bool__(self):
+        return bool(self._parts)
+
+    def clear(self):
+        self.__init__(self.limit)
+
+    def append(self, ptype, text):
+        self._parts.append((ptype, text))
+        self._chars += len(text) + 1
+        # Drop parts that can no longer reach the displayed tail
+        while len(self._parts) > 1 and self._chars - len(self._parts[0][1]) - 1 >= self.limit:
+            self._chars -= len(self._parts.popleft()[1]) + 1
+        self._rendered = self._rendered_html = None
+        if ptype == "tool":
+            self.tool_count += 1
+            self._tools.append(text)
+            self._tool_chars += len(text) + 1
+            while len(self._tools) > 1 and self._tool_chars > self.tool_limit:
+                self._tool_chars -= len(self._tools.popleft()) + 1
+            self._tool_log = None
+        else:
+            self.text_count += 1
+
+    def render(self):
+        """Last `limit` characters of all parts, newline-joined."""
+        if self._rendered is None:
+            self._rendered = "\n".join(text for _, text in self._parts)[-self.limit:]
+        return self._rendered
+
+    def render_html(self):
+        """Telegram HTML of the displayed tail; only new parts are rendered."""
+        if self._rendered_html is None:
+            self._rendered_html = _markdown.tail(self._parts)
+        return self._rendered_html
+
+    def tool_log(self):
+        """Tool entries as a compact process log, oldest ones summarised."""
+        if self._tool_log is None:
+            lines = list(self._tools)
+            earlier = self.tool_count - len(lines)
+            if earlier:
+                lines.insert(0, f"… {earlier} earlier tool calls")
+            self._tool_log = "\n".join(lines)[-self.limit:]
+        return self._tool_log
+
+
+class MarkdownRenderer:
+    """Claude's markdown → the HTML subset Telegram accepts, cached per block."""
+
+    CACHE_SIZE = 512
+    FENCE_RE = re.compile(r'```(\w*)\n?(.*?)```', re.DOTALL)
+    OPEN_FENCE_RE = re.compile(r'```(\w*)\n?(.*)\Z', re.DOTALL)
+    INLINE_RE = re.compile(r'`([^`\n]+)`')
+    BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+    ITALIC_RE = re.compile(r'(?<!\*)\*([^*<]+)\*(?!\*)')    # never spans a tag: stays nested
+    TOKEN_RE = re.compile(r'<(?P<close>/?)(?P<tag>\w+)[^>]*>|&#?\w+;|[^<&]+')
+    ELLIPSIS = "\n…"
+
+    def __init__(self, limit=4000):
+        self.limit = limit    # under Telegram's 4096, leaving room for the session label
+        self._cache = collections.OrderedDict()    # (kind, text) → html
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "renders": 0}
+
+    @staticmethod
+    def escape(s):
+        return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    def block(self, text, kind="text"):
+        """HTML for one block: markdown for "text", escaped as-is otherwise. Cached."""
+        key = (kind, text)
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                self.stats["hits"] += 1
+                return html
+        html = self.markdown(text) if kind == "text" else self.escape(text)
+        with self._lock:
+            self.stats["renders"] += 1
+            self._cache[key] = html
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return html
+
+    @classmethod
+    def markdown(cls, s):
+        """Render one markdown block (uncached)."""
+        blocks, inlines = [], []
+
+        def stash_block(m):
+            blocks.append(m.group(2))
+            return f"\x00B{len(blocks) - 1}\x00"
+
+        def stash_inline(m):
+            inlines.append(m.group(1))
+            return f"\x00I{len(inlines) - 1}\x00"
+
+        s = cls.FENCE_RE.sub(stash_block, s)
+        s = cls.OPEN_FENCE_RE.sub(stash_block, s)    # still being written, or cut
+        s = cls.INLINE_RE.sub(stash_inline, s)
+        s = cls.escape(s)
+        s = cls.BOLD_RE.sub(r'<b>\1</b>', s)
+        s = cls.ITALIC_RE.sub(r'<i>\1</i>', s)
+        for i, code in enumerate(blocks):
+            s = s.replace(f"\x00B{i}\x00", f'<pre>{cls.escape(code.strip())}</pre>')
+        for i, code in enumerate(inlines):
+            s = s.replace(f"\x00I{i}\x00", f'<code>{cls.escape(code)}</code>')
+        return s
+
+    def render(self, blocks, sep="\n\n"):
+        """HTML for a sequence of (kind, text) blocks, cut to `limit` keeping the start."""
+        return self.truncate(sep.join(self.block(text, kind) for kind, text in blocks))
+
+    def tail(self, blocks, sep="\n"):
+        """HTML for the newest (kind, text) blocks that fit in `limit`."""
+        out, size = [], -len(sep)
+        for kind, text in reversed(blocks):
+            html = self.block(text, kind)
+            if size + len(sep) + len(html) <= self.limit:
+                out.append(html)
+                size += len(sep) + len(html)
+                continue
+            room = self.limit - size - len(sep)
+            if room > 0:
+                part = self._tail_block(kind, text, room)
+                if part:
+                    out.append(part)
+            break
+        return sep.join(reversed(out))
+
+    def _tail_block(self, kind, text, room):
+        # Escaping can grow text several times over, so search for the longest tail that fits
+        best, lo, hi = "", 1, min(len(text), room)
+        while lo <= hi:
+            n = (lo + hi) // 2
+            html = self._render_tail(kind, text, n)
+            if len(html) <= room:
+                best, lo = html, n + 1
+            else:
+                hi = n - 1
+        return best
+
+    def _render_tail(self, kind, text, n):
+        """HTML for about the last `n` characters of `text`, starting at a line if one is near."""
+        cut = len(text) - n
+        nl = text.find("\n", cut, cut + n // 2)
+        if nl >= 0:
+            cut = nl + 1
+        piece = text[cut:]
+        if kind == "text":
+            if text.count("```", 0, cut) % 2:
+                piece = "```\n" + piece
+            return self.markdown(piece)
+        return self.escape(piece)
+
+    def truncate(self, html, limit=None):
+        """Cut HTML to `limit` characters, closing every element left open."""
+        limit = limit or self.limit
+        if len(html) <= limit:
+            return html
+        out, stack, size = [], [], 0
+        for m in self.TOKEN_RE.finditer(html):
+            tok, tag = m.group(0), m.group("tag")
+            room = limit - len(self.ELLIPSIS) - size - sum(len(t) + 3 for t in stack)
+            if tag and m.group("close"):
+                if stack and stack[-1] == tag:
+                    stack.pop()
+                    out.append(tok)
+                    size += len(tok)
+                continue
+            if tag:
+                if len(tok) + len(tag) + 3 > room:
+                    break
+                stack.append(tag)
+            elif len(tok) > room:
+                if tok[0] != "&" and room > 0:
+                    out.append(tok[:room])    # text splits anywhere, entities don't
+                break
+            out.append(tok)
+            size += len(tok)
+        out.append(self.ELLIPSIS)
+        out.extend(f"</{t}>" for t in reversed(stack))
+        return "".join(out)
+
+
+_markdown = MarkdownRenderer()
+
+
+class TurnText:
+    """The final answer of the current turn, built from parsed transcript records."""
+
+    def __init__(self, limit=4000):
+        self.limit = limit
+        self.reset()
+
+    def reset(self, offset=None):
+        self.offset = offset    # byte offset of the turn's human message
+        self._parts = []
+        self._chars = 0
+
+    def feed(self, offset, etype, entry):
+        content = entry.get("message", {}).get("content")
+        if etype == "user":
+            if isinstance(content, str):
+                self.reset(offset)
+            return
+        if not isinstance(content, list):
+            return
+        for block in content:
+            if not isinstance(block, dict):
+                continue
+            if block.get("type") == "tool_use":
+                self._parts, self._chars = [], 0
+            elif block.get("type") == "text" and self._chars <= self.limit:
+                self._parts.append(block.get("text", ""))
+                self._chars += len(self._parts[-1]) + 2
+
+    def render(self):
+        text = "\n\n".join(self._parts).strip()
+        if len(text) > self.limit:
+            text = text[:self.limit] + "\n..."
+        return text
+
+    def render_html(self):
+        """The same blocks as Telegram HTML, sharing the live message's rendered blocks."""
+        return _markdown.render([("text", p) for p in self._parts if p.strip()])
+
+
+class TurnFiles:
+    """Files the current turn wrote or edited, for SEND_FILES."""
+
+    EDIT_TOOLS = ("Edit", "MultiEdit")
+
     def __init__(self):
-        super().__init__()
+        self.written = {}     # path → None, in first-write order
+        self.edits = 0
+        self._patch = None
+
+    def __bool__(self):
+        return bool(self.written or self.edits)
+
+    def reset(self):
+        if self._patch:
+            self._patch.close()
+            try:
+                os.remove(self._patch.name)
+            except OSError:
+                pass
+        self.__init__()
+
+    def feed(self, offset, etype, entry):
+        content = entry.get("message", {}).get("content")
+        if etype == "user":
+            if isinstance(content, str):
+                self.reset()
+            return
+        if not isinstance(content, list):
+            return
+        for block in content:
+            if not isinstance(block, dict) or block.get("type") != "tool_use":
+                continue
+            inp = block.get("input") or {}
+            path = inp.get("file_path")
+            if not isinstance(path, str):
+                continue
+            if block.get("name") == "Write":
+                self.written[path] = None
+            elif block.get("name") in self.EDIT_TOOLS:
+                for edit in inp.get("edits") or [inp]:
+                    self._diff(path, edit.get("old_string", ""), edit.get("new_string", ""))
+
+    def _diff(self, path, old, new):
+        if self._patch is None:
+            self._patch = tempfile.NamedTemporaryFile("w", prefix="teleclaude-", suffix=".patch",
+                                                      delete=False, encoding="utf-8")
+        for line in difflib.unified_diff(old.splitlines(True), new.splitlines(True),
+                                         f"a{path}", f"b{path}", n=2):
+            self._patch.write(line if line.endswith("\n") else line + "\n")
+        self.edits += 1
+
+    def take(self):
+        """(written paths, patch path or None, edit count); starts empty. The caller removes the patch."""
+        patch = None
+        if self._patch:
+            self._patch.close()
+            patch = self._patch.name
+            self._patch = None
+        taken = (list(self.written), patch, self.edits)
+        self.__init__()
+        return taken
+
+
+class TranscriptTail:
+    """Incremental reader for a Claude transcript (JSONL)."""
+
+    CHUNK = 1 << 20
+    SNIFF_BYTES = 4096
+    _TYPE_RE = re.compile(rb'"type":\s*"([A-Za-z_-]+)"')
+    _CONTENT_RE = re.compile(rb'"content":\s*(\S)')
+
+    def __init__(self, path=None, pos=0, types=("user", "assistant")):
+        self.types = {t.encode() for t in types}
+        self.seek(pos, path)
+
+    def seek(self, pos, path=None):
+        """Position the reader at byte offset `pos` (optionally of a new file)."""
+        if path is not None:
+            self.path = path
+        self.pos = pos           # bytes read from the file so far
+        self._partial = b""      # incomplete trailing record
+        self._skipping = False   # inside a long record already known to be unwanted
+
+    @property
+    def offset(self):
+        """Offset just past the last complete record consumed."""
+        return self.pos - len(self._partial)
+
+    def _sniff(self, head):
+        """Classify a record from its first bytes: "human", "tool_result" or None (undecided)."""
+        # A leading "type": "user" is top-level; assistant records put "message" (with its own type) first
+        m = self._TYPE_RE.search(head)
+        if not m or m.group(1) != b"user":
+            return None
+        c = self._CONTENT_RE.search(head, m.end())
+        if not c:
+            return None
+        # String content = human message; list = tool_result
+        return "human" if c.group(1) != b"[" else "tool_result"
+
+    def _wanted(self, head):
+        """Decide from a record's first bytes. Returns True, False or None (decode to find out)."""
+        kind = self._sniff(head)
+        if kind is None:
+            return None
+        return kind == "human" and b"user" in self.types
+
+    def read(self, limit=None):
+        """Return [(offset, type, entry)] for complete wanted records appended since the last read."""
+        records = []
+        start = self.pos
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.pos)
+                while not limit or self.pos - start < limit:
+                    chunk = f.read(self.CHUNK)
+                    if not chunk:
+                        break
+                    start_pos = self.pos
+                    self.pos += len(chunk)
+                    if self._skipping:
+                        nl = chunk.find(b"\n")
+                        if nl < 0:
+                            continue
+                        self._skipping = False
+                        chunk = chunk[nl + 1:]
+                        start_pos += nl + 1
+                    buf = self._partial + chunk
+                    base = start_pos - len(self._partial)
+                    lines = buf.split(b"\n")
+                    self._partial = lines.pop()
+                    offset = base
+                    for line in lines:
+                        rec = self._decode(line)
+                        if rec is not None:
+                            records.append((offset, rec[0], rec[1]))
+                        offset += len(line) + 1
+                    if len(self._partial) > self.SNIFF_BYTES and \
+                            self._wanted(self._partial[:self.SNIFF_BYTES]) is False:
+                        # Long unwanted record still being read — stop buffering it
+                        self._partial = b""
+                        self._skipping = True
+        except OSError:
+            pass
+        if self.pos > start:
+            _metrics.inc("transcript_read_bytes_total", self.pos - start)
+        for _offset, etype, _entry in records:
+            _metrics.inc("transcript_records_total", type=etype)
+        return records
+
+    def last_human_offset(self, path=None, block=1 << 16):
+        """Offset of the newest human message, reading backwards from EOF (None if none)."""
+        try:
+            with open(path or self.path, "rb") as f:
+                pos = f.seek(0, os.SEEK_END)
+                following = b""    # head of the line continuing past this block
+                while pos > 0:
+                    n = min(block, pos)
+                    pos -= n
+                    f.seek(pos)
+                    chunk = f.read(n)
+                    end, extra = len(chunk), following
+                    while True:
+                        nl = chunk.rfind(b"\n", 0, end)
+                        if nl < 0:
+                            break
+                        head = chunk[nl + 1:min(end, nl + 1 + self.SNIFF_BYTES)]
+                        if nl + 1 + self.SNIFF_BYTES > end:
+                            head = (head + extra)[:self.SNIFF_BYTES]
+                        if self._is_human(head):
+                            return pos + nl + 1
+                        end, extra = nl, b""
+                    following = (chunk[:min(end, self.SNIFF_BYTES)] + extra)[:self.SNIFF_BYTES]
+                return 0 if self._is_human(following) else None
+        except OSError:
+            return None
+
+    def _is_human(self, head):
+        return self._sniff(head) == "human"
+
+    def _decode(self, line):
+        if not line.strip():
+            return None
+        if self._wanted(line[:self.SNIFF_BYTES]) is False:
+            return None
+        try:
+            entry = _json_loads(line)
+        except ValueError:
+            return None
+        if not isinstance(entry, dict):
+            return None
+        etype = entry.get("type")
+        if not isinstance(etype, str) or etype.encode() not in self.types:
+            return None
+        return etype, entry
+
+
+class TranscriptSearch:
+    """On-disk full-text index over every Claude transcript, behind /search."""
+
+    BATCH_BYTES = 16 << 20    # transcript bytes read per transaction
+    MAX_TEXT = 8000           # characters indexed per message
+    # Bumped when what gets indexed changes; an older index is rebuilt.
+    # 2: assistant records (the reader used to drop them)
+    VERSION = 2
+    SCHEMA = """
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, ino INTEGER, offset INTEGER);
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+            text, session UNINDEXED, project UNINDEXED, role UNINDEXED, ts UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2');
+    """
+
+    def __init__(self, db=SEARCH_DB, root=PROJECTS_DIR):
+        self.db_path = db
+        self.root = root
+        self._lock = threading.Lock()
+        self._db = None
+        self.stats = {"updates": 0, "bytes": 0, "messages": 0, "queries": 0, "removed": 0}
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            if db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+                db.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS messages;")
+            db.executescript(self.SCHEMA)     # no FTS5 in this SQLite → sqlite3.OperationalError
+            db.execute(f"PRAGMA user_version = {self.VERSION}")
+            self._db = db
+        return self._db
+
+    def update(self):
+        """Index what was appended to every transcript since the last update. Returns bytes read."""
+        with self._lock:
+            db = self._connect()
+            known = {path: (ino, offset) for path, ino, offset in db.execute("SELECT path, ino, offset FROM files")}
+            read = 0
+            for path in glob.glob(os.path.join(self.root, "*", "*.jsonl")):
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                ino, offset = known.pop(path, (None, 0))
+                if ino is not None and (ino != st.st_ino or st.st_size < offset):
+                    db.execute("DELETE FROM messages WHERE session = ?", (Path(path).stem,))
+                    offset = 0
+                if st.st_size > offset:
+                    read += self._index(db, path, st.st_ino, offset, st.st_size)
+            # Left in `known`: transcripts deleted since — no resume buttons for them
+            with db:
+                for path in known:
+                    db.execute("DELETE FROM messages WHERE session = ?", (Path(path).stem,))
+                    db.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.stats["removed"] += len(known)
+            self.stats["updates"] += 1
+            self.stats["bytes"] += read
+            return read
+
+    def _index(self, db, path, ino, offset, size):
+        session, project = Path(path).stem, os.path.basename(os.path.dirname(path))
+        tail = TranscriptTail(path, offset)
+        while tail.pos < size:
+            before = tail.pos
+            rows = []
+            for _offset, etype, entry in tail.read(self.BATCH_BYTES):
+                for text in self._texts(etype, entry):
+                    rows.append((text[:self.MAX_TEXT], session, project, etype, entry.get("timestamp", "")))
+            with db:
+                db.executemany("INSERT INTO messages (text, session, project, role, ts) VALUES (?, ?, ?, ?, ?)", rows)
+                db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, ino, tail.offset))
+            self.stats["messages"] += len(rows)
+            if tail.pos == before:
+                break
+        return tail.pos - offset
+
+    @staticmethod
+    def _texts(etype, entry):
+        content = entry.get("message", {}).get("content")
+        if isinstance(content, str):
+            if content.strip():
+                yield content
+        elif etype == "assistant" and isinstance(content, list):
+            for block in content:
+                if isinstance(block, dict) and block.get("type") == "text" and block.get("text", "").strip():
+                    yield block["text"]
+
+    def search(self, query, limit=5):
+        """[(session, project, snippet, timestamp)] for the best-ranked sessions, one hit each."""
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        # Quoted, so user input is never read as FTS5 query syntax
+        match = " ".join(f'"{w}"' for w in words) + "*"
+        with self._lock:
+            db = self._connect()
+            self.stats["queries"] += 1
+            rows = db.execute(
+                "SELECT session, project, snippet(messages, 0, '', '', '…', 12), ts FROM messages "
+                "WHERE messages MATCH ? ORDER BY rank LIMIT 200", (match,))
+            hits, seen = [], set()
+            for row in rows:
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    hits.append(row)
+                    if len(hits) == limit:
+                        break
+            return hits
+
+
+_search = TranscriptSearch()
+
+
+class UsageStats:
+    """Token, turn and tool-call totals per transcript and per day, for /stats."""
+
+    FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+    # Bumped when counting changes; older totals are discarded and recounted.
+    # 2: assistant records (the reader used to drop them)
+    VERSION = 2
+    KEEP_DAYS = 31
+    KEEP_SESSIONS = 200
+    SAVE_INTERVAL = 5
+
+    def __init__(self, path=USAGE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = None
+        self._dirty = False
+        self._saved = 0
+        self.stats = {"records": 0, "messages": 0, "caught_up_bytes": 0, "saves": 0}
+
+    @staticmethod
+    def _zero():
+        return {"turns": 0, "tools": 0, "messages": 0, "input_tokens": 0, "output_tokens": 0,
+                "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+            if not isinstance(self._data, dict) or self._data.get("version") != self.VERSION:
+                self._data = {"version": self.VERSION}
+            for key in ("files", "sessions", "days"):
+                self._data.setdefault(key, {})
+        return self._data
+
+    def feed(self, path, offset, etype, entry):
+        with self._lock:
+            data = self._load()
+            f = data["files"].setdefault(path, {"offset": 0, "last_id": None})
+            if offset < f["offset"]:
+                return      # counted by an earlier read
+            msg = entry.get("message", {})
+            content = msg.get("content")
+            session = data["sessions"].setdefault(Path(path).stem, self._zero())
+            day = data["days"].setdefault(self._day(entry.get("timestamp")), self._zero())
+            session["updated"] = time.time()
+            totals = (session, day)
+            self.stats["records"] += 1
+            if etype == "user":
+                if isinstance(content, str):
+                    for t in totals:
+                        t["turns"] += 1
+            elif etype == "assistant":
+                tools = sum(1 for b in content if isinstance(b, dict) and b.get("type") == "tool_use") \
+                    if isinstance(content, list) else 0
+                usage = msg.get("usage")
+                new_message = isinstance(usage, dict) and msg.get("id") != f["last_id"]
+                f["last_id"] = msg.get("id")
+                self.stats["messages"] += new_message
+                for t in totals:
+                    t["tools"] += tools
+                    if new_message:
+                        t["messages"] += 1
+                        for k in self.FIELDS:
+                            t[k] += usage.get(k) or 0
+            self._dirty = True
+
+    def advance(self, path, offset):
+        """Everything in `path` below `offset` has been fed."""
+        with self._lock:
+            f = self._load()["files"].setdefault(path, {"offset": 0, "last_id": None})
+            if offset > f["offset"]:
+                f["offset"] = offset
+                self._dirty = True
+        self.save()
+
+    def catch_up(self, path, offset):
+        """Count what lies between the stored offset and `offset`, where a reader is about to start."""
+        with self._lock:
+            f = self._load()["files"].get(path, {"offset": 0})
+            start = f["offset"]
+            try:
+                if os.path.getsize(path) < start:
+                    start = f["offset"] = 0    # truncated or replaced
+            except OSError:
+                return
+        if start >= offset:
+            return
+        tail = TranscriptTail(path, start)
+        while tail.offset < offset:
+            before = tail.pos
+            for record in tail.read(TranscriptSearch.BATCH_BYTES):
+                if record[0] < offset:
+                    self.feed(path, *record)
+            if tail.pos == before:
+                break
+        self.stats["caught_up_bytes"] += offset - start
+        self.advance(path, offset)
+
+    @staticmethod
+    def _day(timestamp):
+        try:
+            return datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00")).astimezone().date().isoformat()
+        except (AttributeError, ValueError):
+            return datetime.date.today().isoformat()
+
+    def totals(self, session_id=None, day=None):
+        """(session totals or None, totals for `day`, default today)."""
+        day = day or datetime.date.today().isoformat()
+        with self._lock:
+            data = self._load()
+            session = data["sessions"].get(session_id) if session_id else None
+            return (dict(session) if session else None), dict(data["days"].get(day) or self._zero())
+
+    def save(self, force=False):
+        now = time.time()
+        with self._lock:
+            if not self._dirty or (not force and now - self._saved < self.SAVE_INTERVAL):
+                return
+            data = self._data
+            for key in sorted(data["days"])[:-self.KEEP_DAYS]:
+                del data["days"][key]
+            if len(data["sessions"]) > self.KEEP_SESSIONS:
+                for sid in sorted(data["sessions"], key=lambda k: data["sessions"][k].get("updated", 0))[
+                        :-self.KEEP_SESSIONS]:
+                    del data["sessions"][sid]
+            self._dirty, self._saved = False, now
+            self.stats["saves"] += 1
+            try:
+                write_json_atomic(self.path, data)
+            except OSError as e:
+                print(f"Usage stats: {e}")
+
+
+_usage = UsageStats()
+
+
+def format_tokens(n):
+    """1234567 -> '1.2M', 45300 -> '45.3k'."""
+    if n >= 1_000_000:
+        return f"{n / 1_000_000:.1f}M"
+    if n >= 1000:
+        return f"{n / 1000:.1f}k"
+    return str(n)
+
+
+def format_usage(t):
+    """Multi-line /stats summary of one UsageStats totals dict."""
+    return (f"{t['turns']} turns · {t['messages']} API calls · {t['tools']} tool calls\n"
+            f"in {format_tokens(t['input_tokens'])} · out {format_tokens(t['output_tokens'])}\n"
+            f"cache write {format_tokens(t['cache_creation_input_tokens'])} · "
+            f"cache read {format_tokens(t['cache_read_input_tokens'])}")
+
+
+class FileEvents:
+    """Blocks until watched files change, using inotify where available."""
+
+    IN_ATTRIB = 0x004
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    DIR_MASK = IN_ATTRIB | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, mode=WATCH_MODE):
+        self._dirs = {}      # dir -> wd
+        self._names = {}     # wd -> (dir, {filename})
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._fd = None
+        self._libc = None
+        if mode != "poll":
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if fd >= 0:
+                    self._fd, self._libc = fd, libc
+            except (OSError, AttributeError):
+                pass
+
+    @property
+    def available(self):
+        return self._fd is not None
+
+    def watch(self, paths):
+        """Set the files to watch (replaces the previous set)."""
+        if not self.available:
+            return
+        wanted = {}
+        for p in paths:
+            if p:
+                d, name = os.path.split(os.path.abspath(p))
+                wanted.setdefault(d, set()).add(name)
+        for d in list(self._dirs):
+            if d not in wanted:
+                wd = self._dirs.pop(d)
+                self._names.pop(wd, None)
+                self._libc.inotify_rm_watch(self._fd, wd)
+        for d, names in wanted.items():
+            wd = self._dirs.get(d)
+            if wd is None:
+                wd = self._libc.inotify_add_watch(self._fd, d.encode(), self.DIR_MASK)
+                if wd < 0:
+                    continue
+                self._dirs[d] = wd
+            self._names[wd] = (d, names)
+
+    def wake(self):
+        try:
+            os.write(self._wake_w, b"x")
+        except OSError:
+            pass
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds. Returns the set of watched paths that changed."""
+        fds = [self._wake_r] + ([self._fd] if self.available else [])
+        try:
+            ready, _, _ = select.select(fds, [], [], max(0, timeout))
+        except InterruptedError:
+            return set()
+        changed = set()
+        if self._wake_r in ready:
+            try:
+                while os.read(self._wake_r, 512):
+                    pass
+            except BlockingIOError:
+                pass
+        if self.available and self._fd in ready:
+            changed = self._drain()
+        return changed
+
+    def _drain(self):
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            pos = 0
+            while pos + self._EVENT.size <= len(buf):
+                wd, _mask, _cookie, length = self._EVENT.unpack_from(buf, pos)
+                pos += self._EVENT.size
+                name = buf[pos:pos + length].rstrip(b"\0").decode(errors="replace")
+                pos += length
+                entry = self._names.get(wd)
+                if entry and name in entry[1]:
+                    changed.add(os.path.join(entry[0], name))
+        return changed
+
+
+class PaneWatcher:
+    """Monitors one session's transcript for live updates and its pane for interactive prompts."""
+
+    POLL_INTERVAL = 2    # seconds between checks
+    IDLE_POLL_INTERVAL = 10  # tmux check interval when idle in event-driven mode
+    ACTIVE_WINDOW = 60   # seconds after the last activity that count as active
+    LIVE_INTERVAL = 3    # seconds between live message updates
+    IDLE_THRESHOLD = 4   # seconds of tmux stability for interactive detection
+    COOLDOWN = 15        # minimum seconds between interactive prompt forwards
+    MAX_FILES = 10       # documents per turn with SEND_FILES
+    RESUME_BYTES = 256 << 10  # catch up on at most this much transcript after a restart
+
+    # Kept in the bridge state so they survive restarts
+    live_msg_id = StateField("live_msg_id")
+    hook_msg_id = StateField("hook_msg_id")
+    _transcript_path = StateField("transcript")
+    _transcript_offset = StateField("offset", 0)
+
+    def __init__(self, session, events):
+        self.session = session
+        self.state_scope = session.name
+        session.watcher = self
         # Tmux state (for interactive prompt detection only)
         self.last_content = ""
         self.tmux_stable_since = time.time()
         self.last_forwarded = ""
         self.last_forward_time = 0
         # Live streaming state
-        self.live_msg_id = None
         self.last_live_text = ""
         self.last_live_update = 0
+        self._live_cycle = 0        # bumped whenever the live message is abandoned
+        self._live_sending = False  # sendMessage for the live message in flight
+        self._live_job = None       # its SendJob
         # Transcript-based streaming
-        self._transcript_path = None
-        self._transcript_pos = 0
+        self._tail = TranscriptTail()
         self._last_scan = 0
-        self._response_parts = []
-        # Hook writes response to file; watcher is sole Telegram sender
-        self.hook_msg_id = None
-        # Track pending file mtime to detect new user messages from Telegram
-        self._pending_mtime = 0
+        self._response = ResponseBuffer()
+        self._turn = TurnText()     # final answer, sent when the Stop hook signals
+        self._files = TurnFiles()   # what the turn wrote/edited, when SEND_FILES is on
+        # Hook events received over HOOK_SOCKET, applied on the next tick
+        self._inbox = collections.deque()
+        self._hint_path = None
+        self._stop_signal = None
+        _state.subscribe(self._on_state)
+        self._unshown_since = None  # first transcript growth not yet on Telegram
+        # Pending time seen last, to detect new user messages from Telegram
+        self._pending_seen = None
+        self._hook_file_changed = True   # check once at startup
+        # Wake-ups on hint/pending/hook/transcript changes instead of fixed polling
+        self._events = events
+        self._last_activity = time.time()
+        self.due = 0  # next tick time, managed by WatcherLoop
+        # Control-mode %output tracking: skip captures while the pane is quiet
+        self._output_seq = -1
+        self._pane_quiet = False
+        session.control.on_output = self._on_pane_output
 
-    def run(self):
-        time.sleep(10)
-        # Initialize transcript position to current end (skip history)
+    def prime(self):
+        """Start where the last run stopped if that was recent, otherwise at the current end."""
         t = self._find_transcript()
         if t:
-            self._transcript_path = t
             try:
-                self._transcript_pos = os.path.getsize(t)
+                size = os.path.getsize(t)
             except OSError:
-                pass
-        while True:
-            try:
-                self._tick()
-            except Exception as e:
-                print(f"Watcher: {e}")
-            time.sleep(self.POLL_INTERVAL)
+                return
+            offset = self._transcript_offset if t == self._transcript_path else None
+            if offset is None or not 0 <= size - offset <= self.RESUME_BYTES:
+                offset = size
+            self._transcript_path = t
+            self._tail.seek(offset, t)
 
-    # ── Transcript reading ──────────────────────────────────────────
+    @property
+    def transcript_path(self):
+        """The transcript being followed, or None."""
+        return self._transcript_path
+
+    def watched(self):
+        """Files whose changes should wake this watcher."""
+        s = self.session
+        return [s.transcript_hint, s.hook_response_file, self._transcript_path]
 
-    TRANSCRIPT_HINT = os.path.expanduser("~/.claude/telegram_transcript_path")
+    def next_timeout(self, now):
+        """Seconds until the next timed check is due."""
+        if not self._events.available:
+            return self.POLL_INTERVAL
+        ctl = self.session.control
+        active = (self.session.pending
+                  or now - self._last_activity < self.ACTIVE_WINDOW)
+        timeout = self.POLL_INTERVAL if active else self.IDLE_POLL_INTERVAL
+        # With a control client, pane output wakes us; no need to poll a quiet pane
+        self._pane_quiet = (TMUX_CONTROL and ctl.alive
+                            and ctl.output_seq == self._output_seq
+                            and now - self.tmux_stable_since >= self.IDLE_THRESHOLD)
+        if self._pane_quiet:
+            timeout = self.IDLE_POLL_INTERVAL
+        if self._response and self.last_live_text != self._format_response():
+            # Throttled live update still owed
+            timeout = max(0.05, min(timeout, self.last_live_update + self.LIVE_INTERVAL - now))
+        return timeout
+
+    def hook_event(self, event, payload):
+        """Queue an event from the hook socket and wake the loop. Any thread."""
+        self._inbox.append((event, payload))
+        self.due = 0
+        self._events.wake()
+
+    def _apply_hook_events(self):
+        while self._inbox:
+            event, payload = self._inbox.popleft()
+            path = payload.get("transcript_path")
+            if path and path != self._hint_path:
+                self._hint_path = path
+                self._last_scan = 0     # Follow a new transcript immediately
+            if event == "tool":
+                self._last_activity = time.time()
+            elif event == "stop":
+                self._stop_signal = {"event": "stop", "transcript_path": path}
+                self.session.pending = None
+
+    def notify(self, changed):
+        """Some of this watcher's files changed: tick as soon as possible."""
+        self._last_activity = time.time()
+        self.due = 0
+        if self.session.hook_response_file in changed:
+            self._hook_file_changed = True
+        if self.session.transcript_hint in changed:
+            self._last_scan = 0  # Follow a new transcript immediately
+
+    def _on_state(self, scope, key, old, new):
+        if scope == self.session.name and key == "pending" and new:
+            # A prompt was just sent: follow its transcript immediately
+            self._last_scan = 0
+            self._last_activity = time.time()
+            self.due = 0
+            self._events.wake()
+
+    # ── Transcript reading ──────────────────────────────────────────
 
     def _find_transcript(self):
-        """Find the tmux claude session's transcript via hint file from hooks."""
+        """Find the session's transcript via hint file from hooks."""
         now = time.time()
-        # When PENDING_FILE is active (awaiting response), bypass cache to
-        # detect transcript path changes quickly (e.g. new conversation).
-        cache_ttl = 2 if os.path.exists(PENDING_FILE) else 10
+        # While a response is pending, bypass cache to detect
+        # transcript path changes quickly (e.g. new conversation).
+        cache_ttl = 2 if self.session.pending else 10
         if (self._transcript_path
                 and now - self._last_scan < cache_ttl
                 and os.path.exists(self._transcript_path)):
             return self._transcript_path
         self._last_scan = now
 
-        # Read the hint file written by PostToolUse / Stop hooks
+        # Path from hook socket events, else the hint file written by the hooks
+        if self._hint_path and os.path.exists(self._hint_path):
+            return self._hint_path
         try:
-            with open(self.TRANSCRIPT_HINT) as f:
+            with open(self.session.transcript_hint) as f:
                 path = f.read().strip()
             if path and os.path.exists(path):
                 return path
@@ -295,112 +2628,142 @@ class PaneWatcher(threading.Thread):
         path = self._find_transcript()
         if not path:
             return False
-        if path != self._transcript_path:
+        if path != self._transcript_path or path != self._tail.path:
             self._transcript_path = path
-            if self._pending_mtime > 0:
-                # In a response cycle — read from beginning so the user-message
-                # reset logic finds the latest human entry and we stream the reply.
-                self._transcript_pos = 0
+            self._turn.reset()
+            if self._pending_seen:
+                # In a response cycle — read from the latest human entry so the
+                # user-message reset logic finds it and we stream the reply.
+                self._tail.seek(self._tail.last_human_offset(path) or 0, path)
             else:
                 # Initial startup — skip to end (don't replay old history)
                 try:
-                    self._transcript_pos = os.path.getsize(path)
+                    self._tail.seek(os.path.getsize(path), path)
                 except OSError:
-                    self._transcript_pos = 0
-            self._response_parts = []
-            self.live_msg_id = None
-            self.last_live_text = ""
-            self.hook_msg_id = None
+                    self._tail.seek(0, path)
+            self._reset_cycle()
+            # Count history the tail skipped, so /stats covers the whole session
+            _usage.catch_up(path, self._tail.offset)
         try:
             size = os.path.getsize(path)
         except OSError:
             return False
-        if size <= self._transcript_pos:
+        if size < self._tail.pos:
+            self._tail.seek(0)  # Truncated or replaced — start over
+        if size == self._tail.pos:
             return False
         grew = False
-        try:
-            with open(path) as f:
-                f.seek(self._transcript_pos)
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        entry = json.loads(line)
-                    except json.JSONDecodeError:
-                        continue
-                    if not isinstance(entry, dict):
+        _usage.catch_up(path, self._tail.offset)
+        for offset, etype, entry in self._tail.read():
+            self._turn.feed(offset, etype, entry)
+            _usage.feed(path, offset, etype, entry)
+            if SEND_FILES:
+                self._files.feed(offset, etype, entry)
+            msg_content = entry.get("message", {}).get("content")
+            if etype == "user":
+                # Only human messages get past the reader (tool_results are skipped)
+                if isinstance(msg_content, str):
+                    # Actual user message — new response cycle
+                    self._reset_cycle()
+            elif etype == "assistant":
+                if not isinstance(msg_content, list):
+                    continue
+                for block in msg_content:
+                    if not isinstance(block, dict):
                         continue
-                    etype = entry.get("type")
-                    if etype == "user":
-                        msg_content = entry.get("message", {}).get("content")
-                        # String content = human message; list = tool_result
-                        if isinstance(msg_content, str):
-                            # Actual user message — new response cycle
-                            self._response_parts = []
-                            self.live_msg_id = None
-                            self.last_live_text = ""
-                            self.hook_msg_id = None
-                        # For tool_result entries (list content): keep accumulating
-                    elif etype == "assistant":
-                        msg_content = entry.get("message", {}).get("content", [])
-                        if not isinstance(msg_content, list):
-                            continue
-                        for block in msg_content:
-                            if not isinstance(block, dict):
-                                continue
-                            btype = block.get("type")
-                            if btype == "text" and block.get("text", "").strip():
-                                self._response_parts.append(("text", block["text"]))
-                                grew = True
-                            elif btype == "tool_use":
-                                name = block.get("name", "tool")
-                                inp = block.get("input", {})
-                                detail = _tool_summary(name, inp)
-                                self._response_parts.append(("tool", detail))
-                                grew = True
-                self._transcript_pos = f.tell()
-        except (OSError, IOError):
-            return False
+                    btype = block.get("type")
+                    if btype == "text" and block.get("text", "").strip():
+                        self._response.append("text", block["text"])
+                        grew = True
+                    elif btype == "tool_use":
+                        name = block.get("name", "tool")
+                        inp = block.get("input", {})
+                        detail = _tool_summary(name, inp)
+                        self._response.append("tool", detail)
+                        grew = True
+        self._transcript_offset = self._tail.offset
+        _usage.advance(path, self._tail.offset)
         if grew:
             self._transcript_last_growth = time.time()
+            if self._unshown_since is None:
+                self._unshown_since = self._transcript_last_growth
         return grew
 
+    def _reset_live(self):
+        """Forget the live message; late sendMessage results are ignored."""
+        self.live_msg_id = None
+        self.last_live_text = ""
+        self._live_cycle += 1
+        self._live_sending = False
+        if self._live_job:
+            _outbox.cancel(self._live_job)    # a stale first send still queued
+            self._live_job = None
+
+    def _reset_cycle(self):
+        """Start a new response cycle."""
+        self._reset_live()
+        self.hook_msg_id = None
+        self._response.clear()
+        self._unshown_since = None
+
     def _format_response(self):
         """Format accumulated response parts for display."""
-        lines = []
-        for ptype, text in self._response_parts:
-            if ptype == "text":
-                lines.append(text)
-            elif ptype == "tool":
-                lines.append(text)
-        result = "\n".join(lines)
-        if len(result) > 4000:
-            result = result[-4000:]
-        return result
+        return self._response.render()
 
     def _format_tool_log(self):
         """Format only the tool entries as a compact process log."""
-        lines = []
-        for ptype, text in self._response_parts:
-            if ptype == "tool":
-                lines.append(text)
-        return "\n".join(lines) if lines else ""
+        return self._response.tool_log()
 
     def _has_tool_calls(self):
-        return any(ptype == "tool" for ptype, _ in self._response_parts)
+        return self._response.tool_count > 0
 
     # ── Hook response handling ────────────────────────────────────────
 
+    def _final_response(self, signal):
+        """Text and HTML of the finished turn, from the records already parsed."""
+        self._read_transcript()   # records written just before the hook ran
+        path = signal.get("transcript_path") or self._transcript_path
+        turn = self._turn
+        if path and (path != self._transcript_path or turn.offset is None):
+            tail = TranscriptTail(path)
+            offset = tail.last_human_offset()
+            if offset is None:
+                return None
+            turn = TurnText()
+            tail.seek(offset)
+            for record in tail.read():
+                turn.feed(*record)
+        text = turn.render()
+        if not text:
+            return None
+        return {"html": turn.render_html(), "text": text}
+
     def _read_hook_response(self):
-        """Check if the hook has written a formatted response file."""
+        """Check if the hook has written a response file (or stop signal)."""
+        if self._events.available and not self._hook_file_changed:
+            return None  # inotify reports every write of the file
+        self._hook_file_changed = False
         try:
-            with open(HOOK_RESPONSE_FILE) as f:
+            with open(self.session.hook_response_file) as f:
                 data = json.load(f)
-            os.remove(HOOK_RESPONSE_FILE)
-            return data
+            os.remove(self.session.hook_response_file)
         except (FileNotFoundError, json.JSONDecodeError, IOError):
             return None
+        self.session.pending = None   # file-protocol hooks signal the end of the turn here
+        return data
+
+    def _settle_live(self, timeout=10):
+        """Resolve a pending first live send so the final response edits it."""
+        job = self._live_job
+        if not self._live_sending or self.live_msg_id or not job:
+            return
+        if _outbox.cancel(job):
+            self._live_sending = False
+            return
+        r = job.wait(timeout)
+        if r and r.get("ok") and isinstance(r.get("result"), dict):
+            self.live_msg_id = r["result"].get("message_id")
+        self._live_sending = False
 
     def _finalize_with_hook(self, data, now):
         """Send hook's formatted HTML response. Keep live message as tool log if applicable."""
@@ -411,120 +2774,76 @@ class PaneWatcher(threading.Thread):
         text = data.get("text", "")
         if not html and not text:
             return
+        self._settle_live()
 
         had_tools = self._has_tool_calls()
 
+        bodies = ([{"text": html, "parse_mode": "HTML"}] if html else []) + [{"text": text or html}]
+        attempts = []
         # If live message exists and had tool calls, edit it to a compact tool log
         if self.live_msg_id and had_tools:
             tool_log = self._format_tool_log()
             if tool_log:
-                telegram_api("editMessageText", {
+                self._send("editMessageText", {
                     "chat_id": chat_id,
                     "message_id": self.live_msg_id,
                     "text": "📋 Process:\n" + tool_log,
-                })
-            # Send final response as a NEW message
-            result_msg_id = None
-            if html:
-                r = telegram_api("sendMessage", {
-                    "chat_id": chat_id,
-                    "text": html,
-                    "parse_mode": "HTML",
-                })
-                if r and r.get("ok"):
-                    result_msg_id = r["result"]["message_id"]
-            if not result_msg_id:
-                r = telegram_api("sendMessage", {
-                    "chat_id": chat_id,
-                    "text": text or html,
-                })
-                if r and r.get("ok"):
-                    result_msg_id = r["result"]["message_id"]
-        else:
-            # No tool calls — edit live message in place (or send new)
-            result_msg_id = None
-            if self.live_msg_id:
-                if html:
-                    r = telegram_api("editMessageText", {
-                        "chat_id": chat_id,
-                        "message_id": self.live_msg_id,
-                        "text": html,
-                        "parse_mode": "HTML",
-                    })
-                    if r and r.get("ok"):
-                        result_msg_id = self.live_msg_id
-                if not result_msg_id:
-                    r = telegram_api("editMessageText", {
-                        "chat_id": chat_id,
-                        "message_id": self.live_msg_id,
-                        "text": text or html,
-                    })
-                    if r and r.get("ok"):
-                        result_msg_id = self.live_msg_id
-
-            if not result_msg_id:
-                if html:
-                    r = telegram_api("sendMessage", {
-                        "chat_id": chat_id,
-                        "text": html,
-                        "parse_mode": "HTML",
-                    })
-                    if r and r.get("ok"):
-                        result_msg_id = r["result"]["message_id"]
-                if not result_msg_id:
-                    r = telegram_api("sendMessage", {
-                        "chat_id": chat_id,
-                        "text": text or html,
-                    })
-                    if r and r.get("ok"):
-                        result_msg_id = r["result"]["message_id"]
+                }, PRIORITY_URGENT)
+            # Final response goes out as a NEW message
+        elif self.live_msg_id:
+            # No tool calls — edit live message in place (HTML, then plain)
+            attempts += [("editMessageText", dict(chat_id=chat_id, message_id=self.live_msg_id, **b))
+                         for b in bodies]
+        # Otherwise (or if editing fails) send a new message
+        attempts += [("sendMessage", dict(chat_id=chat_id, **b)) for b in bodies]
 
-        self.hook_msg_id = result_msg_id
-        self.live_msg_id = None
-        self.last_live_text = ""
-        self._response_parts = []
+        self._reset_cycle()
         self.last_live_update = now
+        cycle = self._live_cycle
+        files = self._files.take() if self._files else None
+
+        def applied(r):
+            result_msg_id = r["result"].get("message_id") if r and r.get("ok") else None
+            if cycle == self._live_cycle:
+                self.hook_msg_id = result_msg_id
+            print(f"Watcher: hook response applied (msg {result_msg_id})")
+            if files and result_msg_id:
+                # After the response, and off the send thread: uploads take a while
+                threading.Thread(target=self._send_files, args=(chat_id, *files), daemon=True).start()
+            elif files and files[1]:
+                # Response not delivered (chat gone, bot blocked...): uploads would fail the same way
+                os.remove(files[1])
+
+        method, data = attempts[0]
+        self._send(method, data, PRIORITY_URGENT, callback=applied, fallbacks=attempts[1:])
         # Advance transcript position to EOF — prevents re-reading data that
         # the hook already covered, which would cause duplicate messages
         if self._transcript_path:
             try:
-                self._transcript_pos = os.path.getsize(self._transcript_path)
+                self._tail.seek(os.path.getsize(self._transcript_path), self._transcript_path)
             except OSError:
                 pass
-        print(f"Watcher: hook response applied (msg {result_msg_id})")
 
     # ── Main tick ───────────────────────────────────────────────────
 
-    def _tick(self):
-        if not tmux_exists():
+    def tick(self):
+        self._apply_hook_events()
+        if not tmux_exists(self.session):
             return
 
         now = time.time()
 
         # --- Detect new user message from Telegram (reset state early) ---
-        if os.path.exists(PENDING_FILE):
-            try:
-                pt = os.path.getmtime(PENDING_FILE)
-                if pt != self._pending_mtime:
-                    self._pending_mtime = pt
-                    self.live_msg_id = None
-                    self.last_live_text = ""
-                    self.hook_msg_id = None
-                    self._response_parts = []
-                    self._last_scan = 0  # Force re-scan of transcript
-            except OSError:
-                pass
+        pending = self.session.pending
+        if pending:
+            if pending != self._pending_seen:
+                self._pending_seen = pending
+                self._reset_cycle()
+                self._last_scan = 0  # Force re-scan of transcript
 
-            # Safety net: if Claude not running and PENDING_FILE is stale, clean up
-            try:
-                pending_age = now - os.path.getmtime(PENDING_FILE)
-            except OSError:
-                pending_age = 0
-            if pending_age > 10 and not claude_running_in_tmux():
-                try:
-                    os.remove(PENDING_FILE)
-                except OSError:
-                    pass
+            # Safety net: if Claude not running and the prompt is stale, clean up
+            if now - pending > 10 and not claude_running_in_tmux(self.session):
+                self.session.pending = None
                 return
 
         # --- Always read transcript (keeps position current, detects user messages) ---
@@ -532,15 +2851,20 @@ class PaneWatcher(threading.Thread):
 
         # --- Priority 1: Hook response → finalize and return ---
         hook_response = self._read_hook_response()
+        if self._stop_signal:
+            hook_response, self._stop_signal = self._stop_signal, None
         if hook_response:
-            self._finalize_with_hook(hook_response, now)
+            if hook_response.get("event") == "stop":
+                hook_response = self._final_response(hook_response)
+            if hook_response:
+                self._finalize_with_hook(hook_response, now)
             return
 
         # --- Phase 1: Live updates from transcript (if there's unsent content) ---
-        if self._response_parts and now - self.last_live_update >= self.LIVE_INTERVAL:
+        if self._response and now - self.last_live_update >= self.LIVE_INTERVAL:
             response = self._format_response()
             if response and response != self.last_live_text:
-                self._update_live(response)
+                self._update_live(response, self._response.render_html())
                 self.last_live_update = now
 
         # --- Phase 3: Interactive prompt detection (via tmux capture) ---
@@ -552,6 +2876,7 @@ class PaneWatcher(threading.Thread):
         if tmux_changed:
             self.last_content = content
             self.tmux_stable_since = now
+            self._last_activity = now
             self.hook_msg_id = None  # New activity invalidates old hook msg
 
         tmux_idle = now - self.tmux_stable_since
@@ -569,14 +2894,14 @@ class PaneWatcher(threading.Thread):
                 # Try to add buttons to an existing message
                 target_msg = self.hook_msg_id or self.live_msg_id
                 if target_msg:
-                    telegram_api("editMessageReplyMarkup", {
+                    self._send("editMessageReplyMarkup", {
                         "chat_id": chat_id,
                         "message_id": target_msg,
                         "reply_markup": {"inline_keyboard": keyboard},
-                    })
+                    }, PRIORITY_URGENT)
                     print(f"Watcher: buttons added to msg {target_msg} ({len(options)} opts)")
                     self.hook_msg_id = None
-                elif self._response_parts:
+                elif self._response:
                     # Use transcript text + parsed options
                     base = self._format_response()
                     if options:
@@ -584,86 +2909,88 @@ class PaneWatcher(threading.Thread):
                         text = f"{base}\n\n{opt_lines}" if base else opt_lines
                     else:
                         text = base
-                    telegram_api("sendMessage", {
+                    self._send("sendMessage", {
                         "chat_id": chat_id,
                         "text": text[-4000:],
                         "reply_markup": {"inline_keyboard": keyboard},
-                    })
+                    }, PRIORITY_URGENT)
                     print(f"Watcher: transcript + buttons ({len(options)} opts)")
                 else:
                     # Fallback: no transcript, no hook — screen capture
                     self._forward(content)
                     print("Watcher: screen capture fallback")
-                self.live_msg_id = None
-                self.last_live_text = ""
+                self._reset_live()
             self.last_forwarded = content
             self.last_forward_time = now
 
+    def _on_pane_output(self):
+        if self._pane_quiet:
+            self._pane_quiet = False
+            self.due = 0
+            self._events.wake()
+
     def _capture(self):
-        r = subprocess.run(
-            ["tmux", "capture-pane", "-t", TMUX_SESSION, "-p"],
-            capture_output=True, text=True
-        )
-        return r.stdout.rstrip() if r.returncode == 0 else ""
+        ctl = self.session.control
+        if TMUX_CONTROL and ctl.alive:
+            seq = ctl.output_seq
+            if seq == self._output_seq and self.last_content:
+                return self.last_content  # No %output since the last capture
+            self._output_seq = seq
+        return tmux_capture(session=self.session).rstrip()
 
     def _pane_text(self, content, max_lines=20):
         """Extract last N non-empty lines from pane content, stripping TUI noise."""
-        lines = []
-        for l in content.split('\n'):
-            stripped = l.strip()
-            if not stripped:
-                continue
-            # Skip separator lines
-            if all(c in '─━═┄┅┈┉╌╍─' for c in stripped):
-                continue
-            # Skip status bar and navigation hints
-            if any(p in stripped for p in self.NOISE_PATTERNS):
-                continue
-            lines.append(l)
-        return '\n'.join(lines[-max_lines:])
+        return _pane_classifier.classify(content).text(max_lines)
 
-    @staticmethod
-    def _esc(s):
-        return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-
-    def _update_live(self, text):
-        """Send or edit a live message with transcript text."""
+    def _update_live(self, text, html=None):
+        """Send or edit a live message with transcript text (as HTML when given, plain on failure)."""
         chat_id = self._chat_id()
         if not chat_id or not text or text == self.last_live_text:
             return
-        self.last_live_text = text
+
+        since, self._unshown_since = self._unshown_since, None
+
+        def shown(result):
+            if since and result and result.get("ok"):
+                _metrics.observe("live_update_lag_seconds", time.time() - since)
+
+        def bodies(method, **data):
+            plain = dict(data, text=text)
+            if not html:
+                return plain, ()
+            return dict(data, text=html, parse_mode="HTML"), ((method, plain),)
 
         if self.live_msg_id:
-            telegram_api("editMessageText", {
-                "chat_id": chat_id,
-                "message_id": self.live_msg_id,
-                "text": text,
-            })
+            _metrics.inc("live_updates_total", kind="edit")
+            data, fallbacks = bodies("editMessageText", chat_id=chat_id, message_id=self.live_msg_id)
+            self._send("editMessageText", data, PRIORITY_COSMETIC, callback=shown, fallbacks=fallbacks)
+        elif self._live_sending:
+            # First send still in flight — retry the edit on a later tick
+            return
         else:
-            result = telegram_api("sendMessage", {
-                "chat_id": chat_id,
-                "text": text,
-            })
-            if result and result.get("ok"):
-                self.live_msg_id = result["result"]["message_id"]
-                print(f"Watcher: live message started (msg {self.live_msg_id})")
+            self._live_sending = True
+            cycle = self._live_cycle
+
+            def started(result):
+                shown(result)
+                if cycle != self._live_cycle:
+                    return
+                self._live_sending = False
+                if result and result.get("ok"):
+                    self.live_msg_id = result["result"]["message_id"]
+                    print(f"Watcher: live message started (msg {self.live_msg_id})")
+
+            _metrics.inc("live_updates_total", kind="send")
+            data, fallbacks = bodies("sendMessage", chat_id=chat_id)
+            self._live_job = self._send("sendMessage", data, PRIORITY_COSMETIC, callback=started,
+                                        fallbacks=fallbacks)
+        self.last_live_text = text
 
     def _looks_interactive(self, content):
-        lines = [l for l in content.split('\n') if l.strip()]
-        if not lines:
-            return False
-        tail = '\n'.join(lines[-10:])
-        return any(p in tail for p in self.INTERACTIVE_PATTERNS)
+        return _pane_classifier.classify(content).interactive
 
     def _parse_options(self, content):
-        if 'Enter to select' not in content:
-            return []
-        options = []
-        for line in content.split('\n'):
-            m = re.match(r'\s*(?:❯\s*)?(\d+)\.\s+(.+)', line)
-            if m:
-                options.append({'num': int(m.group(1)), 'text': m.group(2).strip()})
-        return options
+        return _pane_classifier.classify(content).options
 
     def _build_selection_keyboard(self, options):
         keyboard = []
@@ -679,9 +3006,8 @@ class PaneWatcher(threading.Thread):
         return keyboard
 
     def _build_generic_keyboard(self, content):
-        tail = '\n'.join(content.split('\n')[-5:]).lower()
         kb = []
-        if any(p in tail for p in ['(y/n)', '(yes/no)', 'yes', ' no']):
+        if _pane_classifier.classify(content).yes_no:
             kb.append([
                 {"text": "Yes", "callback_data": "pane:y"},
                 {"text": "No", "callback_data": "pane:n"},
@@ -712,302 +3038,1185 @@ class PaneWatcher(threading.Thread):
         if self.live_msg_id:
             # Edit existing live message to add buttons instead of sending duplicate
             msg_data["message_id"] = self.live_msg_id
-            telegram_api("editMessageText", msg_data)
+            self._send("editMessageText", msg_data, PRIORITY_URGENT)
         else:
-            telegram_api("sendMessage", msg_data)
+            self._send("sendMessage", msg_data, PRIORITY_URGENT)
 
         print(f"Watcher: forwarded prompt ({len(options)} options)")
 
+    def _send(self, method, data, priority=PRIORITY_NORMAL, callback=None, fallbacks=()):
+        """Submit a labelled message for this session and remember it for reply routing."""
+        session = self.session
+        chat_id = data.get("chat_id")
+        labelled = []
+        for m, d in [(method, data), *fallbacks]:
+            d = dict(d)
+            if "text" in d:
+                d["text"] = session_label(session, d["text"], d.get("parse_mode") == "HTML")
+            if m == "sendMessage" and session.thread_id:
+                d["message_thread_id"] = session.thread_id
+            labelled.append((m, d))
+
+        def done(r):
+            if r and r.get("ok") and isinstance(r.get("result"), dict):
+                _router.remember(chat_id, r["result"].get("message_id"), session)
+            if callback:
+                callback(r)
+
+        (method, data), fallbacks = labelled[0], labelled[1:]
+        return _outbox.submit(method, data, priority, callback=done, fallbacks=fallbacks)
+
+    def _send_files(self, chat_id, paths, patch, edits):
+        """Upload the files a turn wrote, then its edits as one patch (SEND_FILES)."""
+        limit = SEND_FILES_MAX_MB << 20
+        uploads, skipped = [], []
+        for path in paths[:self.MAX_FILES]:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue    # deleted or renamed since
+            if size > limit:
+                skipped.append(f"{os.path.basename(path)} ({size >> 20} MB)")
+            elif size and os.path.isfile(path):
+                uploads.append((path, None, path))
+        skipped += [os.path.basename(p) for p in paths[self.MAX_FILES:]]
+        if patch:
+            if os.path.getsize(patch) > limit:
+                skipped.append(f"patch of {edits} edits")
+            else:
+                uploads.append((patch, f"edits-{time.strftime('%Y%m%d-%H%M%S')}.patch",
+                                f"{edits} edit{'s' if edits != 1 else ''}"))
+        try:
+            for path, filename, caption in uploads:
+                self._upload(chat_id, path, filename, caption)
+        finally:
+            if patch:
+                os.remove(patch)
+        if skipped:
+            self._send("sendMessage", {"chat_id": chat_id, "text": "Not sent (over "
+                                       f"{SEND_FILES_MAX_MB} MB or too many files): " + ", ".join(skipped)})
+
+    def _upload(self, chat_id, path, filename, caption):
+        caption = session_label(self.session, caption)
+        fields = {"chat_id": chat_id, "message_thread_id": self.session.thread_id, "caption": caption[-1024:]}
+        for _ in range(3):
+            try:
+                status, result = _telegram.upload("sendDocument", fields, "document", path, filename)
+            except Exception as e:
+                print(f"Watcher: upload {path}: {e}")
+                return
+            if status == 429 and isinstance(result, dict):
+                time.sleep(result.get("parameters", {}).get("retry_after", 1))
+                continue
+            break
+        if status == 200 and isinstance(result, dict) and result.get("ok"):
+            _router.remember(chat_id, result["result"].get("message_id"), self.session)
+            _metrics.inc("files_sent_total")
+            print(f"Watcher: sent {path}")
+        else:
+            desc = result.get("description", "") if isinstance(result, dict) else ""
+            print(f"Watcher: upload {path}: HTTP {status} {desc}".rstrip())
+
     def _chat_id(self):
+        return self.session.chat_id
+
+
+class WatcherLoop(threading.Thread):
+    """Drives the PaneWatcher of every bridged session from one thread."""
+    daemon = True
+
+    STARTUP_DELAY = 10
+
+    def __init__(self, registry):
+        super().__init__(name="watcher")
+        self.registry = registry
+        self.events = FileEvents()
+        # Created up front so hook events can queue during the startup delay
+        for session in registry.all():
+            PaneWatcher(session, self.events)
+
+    def run(self):
+        time.sleep(self.STARTUP_DELAY)
+        for session in self.registry.all():
+            session.watcher.prime()
+        self.registry.publish()
+        mode = "event-driven (inotify)" if self.events.available else "polling"
+        print(f"Watcher: {mode}, sessions: {', '.join(s.name for s in self.registry.all())}")
+        while True:
+            added, _removed = self.registry.refresh()
+            for session in added:
+                self._add(session)
+                print(f"Watcher: session '{session.name}' discovered")
+            watchers = [s.watcher for s in self.registry.all() if s.watcher]
+            now = time.time()
+            for watcher in watchers:
+                if watcher.due <= now:
+                    started = time.monotonic()
+                    try:
+                        watcher.tick()
+                    except Exception as e:
+                        print(f"Watcher [{watcher.session.name}]: {e}")
+                    _metrics.observe("watcher_tick_seconds", time.monotonic() - started)
+                    watcher.due = time.time() + watcher.next_timeout(time.time())
+            self._wait(watchers)
+
+    def _add(self, session):
+        if session.watcher is None:
+            PaneWatcher(session, self.events).prime()
+
+    def _wait(self, watchers):
+        """Sleep until a watched file changes or the earliest watcher is due."""
+        by_path = {}
+        for watcher in watchers:
+            for path in watcher.watched():
+                if path:
+                    by_path.setdefault(os.path.abspath(path), []).append(watcher)
+        self.events.watch(by_path)
+        due = min((w.due for w in watchers), default=time.time() + PaneWatcher.IDLE_POLL_INTERVAL)
+        timeout = min(due - time.time(), SessionRegistry.DISCOVER_INTERVAL)
+        changed = self.events.wait(max(0, timeout))
+        hit = {}
+        for path in changed:
+            for watcher in by_path.get(path, ()):
+                hit.setdefault(id(watcher), (watcher, set()))[1].add(path)
+        for watcher, paths in hit.values():
+            watcher.notify(paths)
+
+
+class HookSocket(threading.Thread):
+    """Unix socket the hooks send events to instead of writing files."""
+    daemon = True
+
+    EVENTS = ("tool", "stop", "transcript")
+    MAX_PAYLOAD = 1 << 20
+    TIMEOUT = 2
+
+    def __init__(self, registry, path=HOOK_SOCKET):
+        super().__init__(name="hook-socket")
+        self.registry = registry
+        self.path = path
+        self.stats = {"events": 0, "ignored": 0, "errors": 0}
+        self._sock = None
+
+    def bind(self):
+        """Create the socket, replacing a stale one left by a previous run."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise OSError(f"another bridge is listening on {self.path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(self.path)
+            finally:
+                probe.close()
+        old_umask = os.umask(0o177)
         try:
-            with open(CHAT_ID_FILE) as f:
-                return f.read().strip()
-        except:
-            return None
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        self._sock = sock
 
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
 
-class Handler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    def run(self):
+        try:
+            self.bind()
+        except OSError as e:
+            print(f"Hook socket: {e}; hooks fall back to files")
+            return
+        print(f"Hook socket: {self.path}")
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    self._handle(conn)
+                except (OSError, ValueError) as e:
+                    self.stats["errors"] += 1
+                    print(f"Hook socket: {e}")
+
+    def _handle(self, conn):
+        conn.settimeout(self.TIMEOUT)
+        buf = b""
+        while b"\n" not in buf:
+            chunk = conn.recv(256)
+            if not chunk or len(buf) > 256:
+                raise ValueError("bad header")
+            buf += chunk
+        header, body = buf.split(b"\n", 1)
+        event, pane, length = header.decode().split()
+        length = int(length)
+        if event not in self.EVENTS or not 0 <= length <= self.MAX_PAYLOAD:
+            raise ValueError(f"bad event {header[:64]!r}")
+        while len(body) < length:
+            chunk = conn.recv(min(65536, length - len(body)))
+            if not chunk:
+                raise ValueError("truncated payload")
+            body += chunk
+        self.dispatch(event, pane, json.loads(body) if body.strip() else {})
+
+    def dispatch(self, event, pane, payload):
+        session = self.registry.for_pane(pane)
+        if not session or not session.watcher or not isinstance(payload, dict):
+            self.stats["ignored"] += 1
+            return
+        self.stats["events"] += 1
+        session.watcher.hook_event(event, payload)
+
+
+class ShellCommand:
+    """A shell-mode command typed into the pane as-is and followed until the shell is back at its prompt."""
+
+    POLL_MIN = 0.05       # first capture delay; doubles up to POLL_MAX
+    POLL_MAX = 1.0
+    POLL_BUSY = 0.2       # cap while attached over the control client
+    EDIT_INTERVAL = 3     # seconds between streamed edits (first one after this too)
+    TIMEOUT = float(os.environ.get("SHELL_TIMEOUT", "600"))
+    HISTORY = 2000        # scrollback lines captured
+    LIMIT = 3900          # output chars shown (tail)
+    IDLE_GRACE = 0.3      # seconds the shell must sit at its prompt to count as done
+    CONTINUATION_RE = re.compile(r"^\s*\w*>\s*$")   # "> ", "dquote> ", "heredoc> "...
+
+    def __init__(self, session, command, chat_id, thread_id=None):
+        self.session = session
+        self.command = command.rstrip()
+        self.chat_id = chat_id
+        self.thread_id = thread_id
+        self.msg_id = None
+        self._sending = False
+        self._sent = threading.Event()
+        self._shown = None
+        self._origin = 0          # absolute pane line the command was typed on
+        self._shell = None        # pane_current_command at the prompt
+        self._idle_since = None
+
+    def _pane(self):
+        """(history size, foreground command) of the pane."""
+        _ok, out = tmux_run("display-message", "-t", self.session.name, "-p",
+                            "#{history_size} #{cursor_y} #{pane_current_command}", session=self.session)
+        parts = out.split(None, 2) + ["", "", ""]
+        try:
+            return int(parts[0]), int(parts[1]), parts[2].strip()
+        except ValueError:
+            return 0, 0, ""
+
+    def parse(self, raw, done=False):
+        """Output below the command line; once done, without the prompt that follows it."""
+        lines = [l.rstrip() for l in raw.split("\n")[1:]]
+        while lines and not lines[-1]:
+            lines.pop()
+        if done and lines:
+            lines.pop()
+        return "\n".join(lines).strip("\n")
+
+    def _idle(self, now, command, grown):
+        """True once the shell has waited for input for IDLE_GRACE seconds after the command ran."""
+        waiting = _processes.shell_waiting(self.session)
+        if waiting is None:
+            waiting = command == self._shell
+        if waiting and grown:
+            self._idle_since = self._idle_since or now
+            return now - self._idle_since >= self.IDLE_GRACE
+        self._idle_since = None
+        return False
+
+    def run(self):
+        started = time.time()
+        history, cursor, self._shell = self._pane()
+        self._origin = history + cursor
+        tmux_send(self.command, session=self.session)
+        tmux_send_enter(self.session)
+        ctl = self.session.control
+        delay, seq, last_edit = self.POLL_MIN, None, started
+        raw, done = "", False
+        while True:
+            time.sleep(delay)
+            # Over the control client checking for output is free, so poll
+            # often and capture only when the pane changed; otherwise back off
+            cur = ctl.output_seq if TMUX_CONTROL and ctl.alive else None
+            delay = min(delay * 2, self.POLL_MAX if cur is None else self.POLL_BUSY)
+            history, _cursor, command = self._pane()
+            if cur is None or cur != seq:
+                seq = cur
+                # -S counts from the top of the visible pane; negative reaches into history
+                start = max(self._origin - history, -self.HISTORY)
+                raw = tmux_capture("-J", "-S", str(start), session=self.session)
+            now = time.time()
+            if self._idle(now, command, "\n" in raw.rstrip("\n")):
+                done = True
+                break
+            if now - started > self.TIMEOUT:
+                break
+            output = self.parse(raw)
+            if output and now - last_edit >= self.EDIT_INTERVAL:
+                last_edit = now
+                self._show(self._format(output, f"running {now - started:.0f}s…"), PRIORITY_COSMETIC)
+        elapsed = time.time() - started
+        output = self.parse(raw, done)
+        prompt = raw.rstrip("\n").rsplit("\n", 1)[-1]
+        if done and self.CONTINUATION_RE.match(prompt):
+            status = "shell waiting for more input (unclosed quote or heredoc?)"
+        elif done:
+            status = f"done · {elapsed:.1f}s"
+        else:
+            status = f"still running after {elapsed:.0f}s"
+        if self._sending:
+            self._sent.wait(10)
+        self._show(self._format(output, status), PRIORITY_NORMAL, final=True)
+        print(f"Shell [{self.session.name}]: {self.command[:50]} → {status}")
+
+    def _format(self, output, status):
+        if len(output) > self.LIMIT:
+            output = "…" + output[-self.LIMIT:]
+        return f"{output or '(no output)'}\n\n[{status}]"
+
+    def _show(self, text, priority, final=False):
+        if text == self._shown:
+            return
+        data = {"chat_id": self.chat_id, "text": session_label(self.session, text)}
+        if self.thread_id:
+            data["message_thread_id"] = self.thread_id
+        if self.msg_id:
+            data["message_id"] = self.msg_id
+            _outbox.submit("editMessageText", data, priority)
+        elif self._sending and not final:
+            return      # first message still in flight
+        else:
+            self._sending = True
+
+            def sent(result):
+                if result and result.get("ok"):
+                    self.msg_id = result["result"]["message_id"]
+                    _router.remember(self.chat_id, self.msg_id, self.session)
+                self._sending = False
+                self._sent.set()
+            _outbox.submit("sendMessage", data, priority, callback=sent)
+        self._shown = text
+
+
+class PaneSequence:
+    """Keystrokes sent step by step, each once the pane is ready for it."""
+
+    POLL_MIN = 0.02
+    POLL_MAX = 0.25
+    EXIT_TIMEOUT = 10     # Claude shutting down after /exit
+    START_TIMEOUT = 15    # Claude starting after `claude ...`
+    IDLE_TIMEOUT = 3      # Claude back at its prompt after Escape
+    CURSOR_TIMEOUT = 2    # ❯ reaching the selected option
+
+    def __init__(self, session):
+        self.session = session
+        self.steps = []       # [(description, ok, seconds)]
+
+    def keys(self, *keys):
+        """Send keys in one tmux call. Words that are not key names are typed as-is."""
+        tmux_send_keys(*keys, session=self.session)
+
+    def wait(self, what, predicate, timeout):
+        started = time.monotonic()
+        delay = self.POLL_MIN
+        while True:
+            try:
+                ok = bool(predicate())
+            except Exception:
+                ok = False
+            elapsed = time.monotonic() - started
+            if ok or elapsed >= timeout:
+                break
+            time.sleep(min(delay, timeout - elapsed))
+            delay = min(delay * 2, self.POLL_MAX)
+        self.steps.append((what, ok, elapsed))
+        print(f"Sequence [{self.session.name}]: {what}: {'ok' if ok else 'timed out'} after {elapsed:.2f}s")
+        return ok
+
+    def failure(self):
+        """Describe the step that timed out, or None."""
+        for what, ok, elapsed in self.steps:
+            if not ok:
+                return f"{what}: no change after {elapsed:.1f}s"
+        return None
+
+    # Pane state
+
+    def at_shell(self):
+        """The pane's shell is back in the foreground (Claude has exited)."""
+        info = _processes.inspect(self.session, max_age=0)
+        return bool(info and info.at_shell)
+
+    def claude_ready(self):
+        """Claude is at its input prompt: not mid-turn and no menu or question open."""
+        view = _pane_classifier.classify(tmux_capture(session=self.session))
+        tail = "\n".join(view.lines[-6:]).lower()
+        return "esc to interrupt" not in tail and not view.interactive
+
+    def cursor(self):
+        return _pane_classifier.classify(tmux_capture(session=self.session)).cursor
+
+    # Flows
+
+    def settle(self):
+        """Escape out of a running turn or open menu, and wait until Claude shows its prompt."""
+        if self.claude_ready():
+            return True
+        self.keys("Escape")
+        return self.wait("Claude returns to its prompt", self.claude_ready, self.IDLE_TIMEOUT)
+
+    def restart_claude(self, args):
+        """Exit Claude if it is running, then start `claude <args>` once the shell is back."""
+        if not self.at_shell():
+            if not self.settle():
+                return False    # "/exit" would be typed into whatever is still open
+            self.keys("/exit", "Enter")
+            if not self.wait("Claude exits", self.at_shell, self.EXIT_TIMEOUT):
+                return False    # typing the command now would send it to Claude as a prompt
+        self.keys(f"claude {args}", "Enter")
+        return self.wait("Claude starts", lambda: not self.at_shell(), self.START_TIMEOUT)
+
+    def select(self, target):
+        """Move ❯ to option `target` and press Enter once it is there."""
+        current = self.cursor() or 1
+        delta = target - current
+        if delta:
+            self.keys(*["Down" if delta > 0 else "Up"] * abs(delta))
+            if not self.wait(f"cursor reaches option {target}", lambda: self.cursor() == target,
+                             self.CURSOR_TIMEOUT):
+                return False
+        self.keys("Enter")
+        return True
+
+
+class Bot:
+    """Handles one Telegram update: slash commands, prompts and button callbacks."""
+
+    def handle_update(self, update):
         try:
-            update = json.loads(body)
             if "callback_query" in update:
                 self.handle_callback(update["callback_query"])
             elif "message" in update:
                 self.handle_message(update)
         except Exception as e:
             print(f"Error: {e}")
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"OK")
-
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Claude-Telegram Bridge")
 
     def handle_callback(self, cb):
-        chat_id = cb.get("message", {}).get("chat", {}).get("id")
+        msg = cb.get("message", {})
+        chat_id, thread_id = msg.get("chat", {}).get("id"), msg.get("message_thread_id")
         data = cb.get("data", "")
-        telegram_api("answerCallbackQuery", {"callback_query_id": cb.get("id")})
+        _outbox.submit("answerCallbackQuery", {"callback_query_id": cb.get("id")})
+
+        if data.startswith("session:"):
+            self.select_session(chat_id, thread_id, data.split(":", 1)[1])
+            return
+
+        session = _router.resolve(chat_id, thread_id, msg.get("message_id"))
 
-        if not tmux_exists():
-            self.reply(chat_id, "tmux session not found")
+        if not tmux_exists(session):
+            self.reply(chat_id, "tmux session not found", thread_id)
             return
 
         if data.startswith("pane:"):
             action = data.split(":", 1)[1]
             if action == "y":
-                tmux_send("y")
-                tmux_send_enter()
+                tmux_send("y", session=session)
+                tmux_send_enter(session)
             elif action == "n":
-                tmux_send("n")
-                tmux_send_enter()
+                tmux_send("n", session=session)
+                tmux_send_enter(session)
             elif action == "enter":
-                tmux_send_enter()
+                tmux_send_enter(session)
             elif action == "esc":
-                tmux_send_escape()
+                tmux_send_escape(session)
             return
 
         if data.startswith("sel:"):
             # sel:{target}:{total} — navigate selection list via arrow keys
-            target = int(data.split(":")[1])
-            # Read current ❯ position in real time
-            r = subprocess.run(
-                ["tmux", "capture-pane", "-t", TMUX_SESSION, "-p"],
-                capture_output=True, text=True,
-            )
-            current = 1
-            if r.returncode == 0:
-                for line in r.stdout.split('\n'):
-                    m = re.match(r'\s*❯\s*(\d+)\.', line)
-                    if m:
-                        current = int(m.group(1))
-                        break
-            delta = target - current
-            key = "Down" if delta > 0 else "Up"
-            for _ in range(abs(delta)):
-                tmux_send(key, literal=False)
-                time.sleep(0.05)
-            time.sleep(0.15)
-            tmux_send_enter()
+            seq = PaneSequence(session)
+            if not seq.select(int(data.split(":")[1])):
+                self.reply(chat_id, f"Selection failed ({seq.failure()})", thread_id)
             return
 
         if data.startswith("resume:"):
             session_id = data.split(":", 1)[1]
-            tmux_send_escape()
-            time.sleep(0.2)
-            tmux_send("/exit")
-            tmux_send_enter()
-            time.sleep(0.5)
-            tmux_send(f"claude --resume {session_id} --dangerously-skip-permissions")
-            tmux_send_enter()
-            self.reply(chat_id, f"Resuming: {session_id[:8]}...")
+            self.restart_claude(chat_id, thread_id, session,
+                                f"--resume {session_id} --dangerously-skip-permissions",
+                                f"Resuming: {session_id[:8]}...")
 
         elif data == "continue_recent":
-            tmux_send_escape()
-            time.sleep(0.2)
-            tmux_send("/exit")
-            tmux_send_enter()
-            time.sleep(0.5)
-            tmux_send("claude --continue --dangerously-skip-permissions")
-            tmux_send_enter()
-            self.reply(chat_id, "Continuing most recent...")
+            self.restart_claude(chat_id, thread_id, session, "--continue --dangerously-skip-permissions",
+                                "Continuing most recent...")
+
+    def restart_claude(self, chat_id, thread_id, session, args, done):
+        seq = PaneSequence(session)
+        if seq.restart_claude(args):
+            self.reply(chat_id, done, thread_id, session)
+        else:
+            self.reply(chat_id, f"Restart failed ({seq.failure()})", thread_id, session)
 
     def handle_message(self, update):
         msg = update.get("message", {})
         text, chat_id, msg_id = msg.get("text", ""), msg.get("chat", {}).get("id"), msg.get("message_id")
-        if not text or not chat_id:
+        attached = msg.get("document") or msg.get("photo")
+        if not (text or attached) or not chat_id:
             return
+        thread_id = msg.get("message_thread_id") if msg.get("is_topic_message") else None
+        reply_to = msg.get("reply_to_message", {}).get("message_id")
+        session = _router.resolve(chat_id, thread_id, reply_to)
 
-        with open(CHAT_ID_FILE, "w") as f:
-            f.write(str(chat_id))
+        if attached:
+            path = self.receive_file(msg, session, chat_id, thread_id)
+            if not path:
+                return
+            if not claude_running_in_tmux(session, max_age=0):
+                self.reply(chat_id, f"Saved to {path}", thread_id, session)
+                return
+            # Captions are prompts, never commands
+            caption = " ".join(msg.get("caption", "").split())
+            text = f"{caption} [attached: {path}]" if caption else f"[attached: {path}]"
 
-        if text.startswith("/"):
+        elif text.startswith("/"):
             cmd = text.split()[0].lower()
 
             if cmd == "/status":
-                status = "running" if tmux_exists() else "not found"
-                self.reply(chat_id, f"tmux '{TMUX_SESSION}': {status}")
+                status = "running" if tmux_exists(session) else "not found"
+                info = _processes.inspect(session, max_age=0) if status == "running" else None
+                if info and info.claude_running:
+                    up = f", up {int(info.claude_uptime // 60)}m" if info.claude_uptime is not None else ""
+                    fg = "" if info.claude_foreground else ", in background"
+                    status += f"\nClaude: pid {info.claude_pid}{up}{fg}"
+                elif info:
+                    status += "\nClaude: not running (shell mode)"
+                self.reply(chat_id, f"tmux '{session.name}': {status}", thread_id)
+                return
+
+            if cmd == "/sessions":
+                kb = [[{"text": ("● " if s is session else "") + s.name,
+                        "callback_data": f"session:{s.name}"}] for s in _sessions.all()]
+                _outbox.submit("sendMessage", self._target(chat_id, thread_id, text="Select session:",
+                                                          reply_markup={"inline_keyboard": kb}))
+                return
+
+            if cmd == "/session":
+                parts = text.split(maxsplit=1)
+                if len(parts) < 2:
+                    self.reply(chat_id, f"Current session: {session.name}", thread_id)
+                else:
+                    self.select_session(chat_id, thread_id, parts[1].strip())
                 return
 
             if cmd == "/stop":
-                if tmux_exists():
-                    tmux_send_escape()
-                if os.path.exists(PENDING_FILE):
-                    os.remove(PENDING_FILE)
-                self.reply(chat_id, "Interrupted")
+                if tmux_exists(session):
+                    tmux_send_escape(session)
+                session.pending = None
+                self.reply(chat_id, "Interrupted", thread_id, session)
                 return
 
             if cmd == "/clear":
-                if not tmux_exists():
-                    self.reply(chat_id, "tmux not found")
+                if not tmux_exists(session):
+                    self.reply(chat_id, "tmux not found", thread_id, session)
+                    return
+                seq = PaneSequence(session)
+                if not seq.settle():
+                    # A menu or turn still open would take "/clear" as its input
+                    self.reply(chat_id, f"Clear failed ({seq.failure()})", thread_id, session)
                     return
-                tmux_send_escape()
-                time.sleep(0.2)
-                tmux_send("/clear")
-                tmux_send_enter()
-                self.reply(chat_id, "Cleared")
+                seq.keys("/clear", "Enter")
+                self.reply(chat_id, "Cleared", thread_id, session)
                 return
 
             if cmd == "/continue_":
-                if not tmux_exists():
-                    self.reply(chat_id, "tmux not found")
+                if not tmux_exists(session):
+                    self.reply(chat_id, "tmux not found", thread_id, session)
                     return
-                tmux_send_escape()
-                time.sleep(0.2)
-                tmux_send("/exit")
-                tmux_send_enter()
-                time.sleep(0.5)
-                tmux_send("claude --continue --dangerously-skip-permissions")
-                tmux_send_enter()
-                self.reply(chat_id, "Continuing...")
+                self.restart_claude(chat_id, thread_id, session, "--continue --dangerously-skip-permissions",
+                                    "Continuing...")
                 return
 
             if cmd == "/loop":
-                if not tmux_exists():
-                    self.reply(chat_id, "tmux not found")
+                if not tmux_exists(session):
+                    self.reply(chat_id, "tmux not found", thread_id, session)
                     return
                 parts = text.split(maxsplit=1)
                 if len(parts) < 2:
-                    self.reply(chat_id, "Usage: /loop <prompt>")
+                    self.reply(chat_id, "Usage: /loop <prompt>", thread_id)
                     return
                 prompt = parts[1].replace('"', '\\"')
                 full = f'{prompt} Output <promise>DONE</promise> when complete.'
-                with open(PENDING_FILE, "w") as f:
-                    f.write(str(int(time.time())))
-                threading.Thread(target=send_typing_loop, args=(chat_id,), daemon=True).start()
-                tmux_send(f'/ralph-loop:ralph-loop "{full}" --max-iterations 5 --completion-promise "DONE"')
+                session.pending = time.time()
+                threading.Thread(target=send_typing_loop, args=(chat_id, session), daemon=True).start()
+                tmux_send(f'/ralph-loop:ralph-loop "{full}" --max-iterations 5 --completion-promise "DONE"',
+                          session=session)
                 time.sleep(0.3)
-                tmux_send_enter()
-                self.reply(chat_id, "Ralph Loop started (max 5 iterations)")
+                tmux_send_enter(session)
+                self.reply(chat_id, "Ralph Loop started (max 5 iterations)", thread_id, session)
+                return
+
+            if cmd == "/search":
+                parts = text.split(maxsplit=1)
+                if len(parts) < 2:
+                    self.reply(chat_id, "Usage: /search <terms>", thread_id)
+                    return
+                try:
+                    _search.update()
+                    hits = _search.search(parts[1])
+                except sqlite3.Error as e:
+                    self.reply(chat_id, f"Search unavailable: {e}", thread_id)
+                    return
+                if not hits:
+                    self.reply(chat_id, "No matches", thread_id)
+                    return
+                lines, kb = [], []
+                for i, (sid, project, snippet, ts) in enumerate(hits, 1):
+                    snippet = " ".join(snippet.split())
+                    lines.append(f"{i}. {project.rsplit('-', 1)[-1]} · {ts[:10]}\n{snippet}")
+                    kb.append([{"text": f"{i}. {snippet[:36]}", "callback_data": f"resume:{sid}"}])
+                def listed(r, s=session):
+                    if r and r.get("ok"):
+                        _router.remember(chat_id, r["result"].get("message_id"), s)
+                _outbox.submit("sendMessage", self._target(chat_id, thread_id, text="\n\n".join(lines)[:4000],
+                                                          reply_markup={"inline_keyboard": kb}),
+                               callback=listed)
+                return
+
+            if cmd == "/stats":
+                path = session.watcher.transcript_path if session.watcher else None
+                current, today = _usage.totals(Path(path).stem if path else None)
+                lines = [f"Session {Path(path).stem[:8]}:\n{format_usage(current)}" if current
+                         else "Session: no transcript yet", f"Today:\n{format_usage(today)}"]
+                self.reply(chat_id, "\n\n".join(lines), thread_id)
                 return
 
             if cmd == "/resume":
                 sessions = get_recent_sessions()
                 if not sessions:
-                    self.reply(chat_id, "No sessions")
+                    self.reply(chat_id, "No sessions", thread_id)
                     return
                 kb = [[{"text": "Continue most recent", "callback_data": "continue_recent"}]]
-                for s in sessions:
-                    sid = get_session_id(s.get("project", ""))
+                sids = get_session_ids([s.get("project", "") for s in sessions])
+                for s, sid in zip(sessions, sids):
                     if sid:
                         kb.append([{"text": s.get("display", "?")[:40] + "...", "callback_data": f"resume:{sid}"}])
-                telegram_api("sendMessage", {"chat_id": chat_id, "text": "Select session:", "reply_markup": {"inline_keyboard": kb}})
+                def listed(r, s=session):
+                    # Resume buttons act on the session that listed them
+                    if r and r.get("ok"):
+                        _router.remember(chat_id, r["result"].get("message_id"), s)
+                _outbox.submit("sendMessage", self._target(chat_id, thread_id, text="Select session:",
+                                                          reply_markup={"inline_keyboard": kb}),
+                               callback=listed)
                 return
 
             if cmd in BLOCKED_COMMANDS:
-                self.reply(chat_id, f"'{cmd}' not supported (interactive)")
+                self.reply(chat_id, f"'{cmd}' not supported (interactive)", thread_id)
                 return
 
             # Unrecognized /command while Claude is running → Claude internal command
-            if claude_running_in_tmux():
-                def handle_claude_cmd(c_text=text, c_chat=chat_id):
-                    tmux_send(c_text)
-                    tmux_send_enter()
+            if claude_running_in_tmux(session):
+                def handle_claude_cmd(c_text=text, c_chat=chat_id, c_thread=thread_id):
+                    tmux_send(c_text, session=session)
+                    tmux_send_enter(session)
                     time.sleep(2.5)
                     try:
-                        raw = subprocess.check_output(
-                            ["tmux", "capture-pane", "-t", TMUX_SESSION, "-p"],
-                            stderr=subprocess.DEVNULL
-                        ).decode()
-                        noise = ['bypass permissions', 'shift+tab', 'esc to interrupt',
-                                 'Press Enter to send', 'to navigate']
-                        lines = []
-                        for line in raw.split("\n"):
-                            stripped = line.strip()
-                            if not stripped:
-                                continue
-                            if any(n in stripped.lower() for n in noise):
-                                continue
-                            lines.append(line.rstrip())
-                        out = "\n".join(lines).strip()
+                        view = _pane_classifier.classify(tmux_capture(session=session))
+                        out = "\n".join(l.rstrip() for l in view.text().split("\n")).strip()
                         if out:
-                            telegram_api("sendMessage", {
-                                "chat_id": c_chat,
-                                "text": out[-4000:],
-                            })
+                            _outbox.submit("sendMessage", self._target(c_chat, c_thread, text=out[-4000:]))
                     except Exception as e:
-                        telegram_api("sendMessage", {"chat_id": c_chat, "text": f"Error: {e}"})
+                        _outbox.submit("sendMessage", self._target(c_chat, c_thread, text=f"Error: {e}"))
                 threading.Thread(target=handle_claude_cmd, daemon=True).start()
                 return
 
         # Regular message
-        print(f"[{chat_id}] {text[:50]}...")
+        print(f"[{chat_id} → {session.name}] {text[:50]}...")
 
-        if not tmux_exists():
-            self.reply(chat_id, "tmux not found")
+        if not tmux_exists(session):
+            self.reply(chat_id, "tmux not found", thread_id, session)
             return
 
         if msg_id:
-            telegram_api("setMessageReaction", {"chat_id": chat_id, "message_id": msg_id, "reaction": [{"type": "emoji", "emoji": "\u2705"}]})
+            _outbox.submit("setMessageReaction", {"chat_id": chat_id, "message_id": msg_id, "reaction": [{"type": "emoji", "emoji": "\u2705"}]}, PRIORITY_COSMETIC)
 
-        if not claude_running_in_tmux():
+        # Fresh check: a stale answer would type a prompt into the shell or a command into Claude
+        if not claude_running_in_tmux(session, max_age=0):
             # Shell mode: run command directly and return output
             def run_shell():
                 try:
-                    cwd = subprocess.check_output(
-                        ["tmux", "display-message", "-t", TMUX_SESSION, "-p", "#{pane_current_path}"],
-                        stderr=subprocess.DEVNULL
-                    ).decode().strip() or os.path.expanduser("~")
-                    tmux_send(text)
-                    tmux_send_enter()
-                    time.sleep(1.5)  # Wait for command to finish
-                    # Capture pane scrollback and extract last command's output
-                    raw = subprocess.check_output(
-                        ["tmux", "capture-pane", "-t", TMUX_SESSION, "-p", "-S", "-100"],
-                        stderr=subprocess.DEVNULL
-                    ).decode()
-                    # Split into lines, strip trailing blanks, find the output
-                    lines = raw.rstrip().split("\n")
-                    # Walk backwards to find the command we sent
-                    output_lines = []
-                    found_cmd = False
-                    for line in reversed(lines):
-                        if not found_cmd:
-                            # Skip the current prompt line (usually last non-empty line)
-                            if line.strip().endswith("$") or line.strip().endswith("#") or line.strip().endswith("%"):
-                                continue
-                            found_cmd = True
-                        if found_cmd:
-                            # Stop when we hit the line containing our command
-                            if text.strip() in line:
-                                break
-                            output_lines.insert(0, line)
-                    output = "\n".join(output_lines).strip()
-                    if not output:
-                        output = "(no output)"
-                    self.reply(chat_id, output[-4000:])
+                    ShellCommand(session, text, chat_id, thread_id).run()
                 except Exception as e:
-                    self.reply(chat_id, f"Error: {e}")
+                    self.reply(chat_id, f"Error: {e}", thread_id, session)
             threading.Thread(target=run_shell, daemon=True).start()
             return
 
-        with open(PENDING_FILE, "w") as f:
-            f.write(str(int(time.time())))
+        # The turn's output (live messages, final response, files) goes to whoever asked
+        self.bind_output(session, chat_id, thread_id)
+        session.pending = time.time()
+
+        threading.Thread(target=send_typing_loop, args=(chat_id, session), daemon=True).start()
+        tmux_send(text, session=session)
+        tmux_send_enter(session)
+
+    def receive_file(self, msg, session, chat_id, thread_id):
+        """Download a message's document or photo into the pane's cwd. Returns the path, or None."""
+        if msg.get("document"):
+            doc = msg["document"]
+            mime = doc.get("mime_type") or "application/octet-stream"
+            name = doc.get("file_name") or f"document-{doc.get('file_unique_id', 'file')}"
+        else:
+            # Largest size Telegram made of the photo
+            doc = max(msg["photo"], key=lambda p: p.get("width", 0) * p.get("height", 0))
+            mime = "image/jpeg"
+            name = f"photo-{time.strftime('%Y%m%d-%H%M%S')}-{doc.get('file_unique_id', '')}.jpg"
+        limit = RECEIVE_MAX_MB << 20
+        if not mime_allowed(mime):
+            self.reply(chat_id, f"Not saved: {mime} files are not accepted (RECEIVE_TYPES)", thread_id)
+            return None
+        if doc.get("file_size", 0) > limit:
+            self.reply(chat_id, f"Not saved: larger than {RECEIVE_MAX_MB} MB", thread_id)
+            return None
+        info = telegram_api("getFile", {"file_id": doc.get("file_id")})
+        remote = (info or {}).get("result", {}).get("file_path")
+        if not remote:
+            self.reply(chat_id, "Not saved: Telegram did not return the file", thread_id)
+            return None
+        ok, cwd = tmux_run("display-message", "-t", session.name, "-p", "#{pane_current_path}", session=session)
+        folder = os.path.join(cwd.strip() if ok and cwd.strip() else os.path.expanduser("~"), RECEIVE_DIR)
+        dest = unique_path(folder, name)
+        started = time.monotonic()
+        try:
+            os.makedirs(folder, exist_ok=True)
+            size = _telegram.download(remote, dest, limit)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            self.reply(chat_id, f"Not saved: {e}", thread_id)
+            return None
+        _metrics.inc("files_received_total")
+        print(f"[{chat_id} → {session.name}] saved {dest} ({size} bytes, {time.monotonic() - started:.1f}s)")
+        return dest
+
+    def select_session(self, chat_id, thread_id, name):
+        session = _sessions.get(name)
+        if not session:
+            names = ", ".join(s.name for s in _sessions.all())
+            self.reply(chat_id, f"Unknown session '{name}'. Available: {names}", thread_id)
+            return
+        _router.bind(chat_id, session, thread_id)
+        self.bind_output(session, chat_id, thread_id)
+        where = "this topic" if thread_id else "this chat"
+        self.reply(chat_id, f"Messages in {where} now go to '{session.name}', and its output comes here",
+                   thread_id)
+
+    @staticmethod
+    def bind_output(session, chat_id, thread_id):
+        """Send the session's watcher output (live messages, final responses, files) to this chat or topic."""
+        session.chat_id = str(chat_id)
+        session.thread_id = thread_id
+
+    @staticmethod
+    def _target(chat_id, thread_id, **data):
+        data["chat_id"] = chat_id
+        if thread_id:
+            data["message_thread_id"] = thread_id
+        return data
+
+    def reply(self, chat_id, text, thread_id=None, session=None):
+        """Send `text`; about `session`, it is labelled like the session's own output."""
+        if session:
+            text = session_label(session, text)
+        _outbox.submit("sendMessage", self._target(chat_id, thread_id, text=text))
+
+
+def mime_allowed(mime, accepted=RECEIVE_TYPES):
+    for pattern in accepted.split(","):
+        pattern = pattern.strip()
+        if pattern == "*" or pattern == mime or (pattern.endswith("/*") and mime.startswith(pattern[:-1])):
+            return True
+    return False
+
+
+def unique_path(folder, name):
+    """`folder`/`name` with the name reduced to a safe basename, numbered if it exists."""
+    name = re.sub(r"[^\w.+-]", "_", os.path.basename(name)).lstrip(".") or "file"
+    stem, ext = os.path.splitext(name)
+    path, n = os.path.join(folder, name), 1
+    while os.path.exists(path) or os.path.exists(f"{path}.part"):
+        path = os.path.join(folder, f"{stem}-{n}{ext}")
+        n += 1
+    return path
+
 
-        threading.Thread(target=send_typing_loop, args=(chat_id,), daemon=True).start()
-        tmux_send(text)
-        tmux_send_enter()
+def update_chat_id(update):
+    """Chat an update belongs to (None for updates without one)."""
+    msg = update.get("message") or update.get("callback_query", {}).get("message") or {}
+    return msg.get("chat", {}).get("id")
 
-    def reply(self, chat_id, text):
-        telegram_api("sendMessage", {"chat_id": chat_id, "text": text})
+
+def is_stop_command(update):
+    text = update.get("message", {}).get("text", "")
+    return text.split(maxsplit=1)[0].lower() == "/stop" if text.strip() else False
+
+
+class RecentIds:
+    """Recently seen ids, oldest evicted first once `size` is reached, each kept `ttl` seconds."""
+
+    def __init__(self, size=4096, ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self._seen = collections.OrderedDict()   # id → first seen (monotonic)
+
+    def __len__(self):
+        return len(self._seen)
+
+    def check(self, key):
+        """True if `key` was seen within the TTL; otherwise record it and return False."""
+        now = time.monotonic()
+        # Oldest first: expire from the front until a fresh entry
+        while self._seen:
+            oldest, seen = next(iter(self._seen.items()))
+            if now - seen < self.ttl:
+                break
+            del self._seen[oldest]
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        if len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+        return False
+
+    def forget(self, key):
+        self._seen.pop(key, None)
+
+
+class UpdateDispatcher:
+    """Runs updates on a bounded worker pool, in arrival order per chat."""
+
+    MAX_QUEUED = 256
+    DEDUP_SIZE = 4096
+    DEDUP_TTL = 3600      # Telegram keeps retrying an unacknowledged update for hours at most
+
+    def __init__(self, bot, workers=DISPATCH_WORKERS):
+        self.bot = bot
+        self.workers = max(1, workers)
+        self._cond = threading.Condition()
+        self._queues = {}                   # chat_id -> deque[(enqueued, update)]
+        self._ready = collections.deque()   # chats with queued work and no worker
+        self._busy = set()
+        self._depth = 0
+        self._recent = RecentIds(self.DEDUP_SIZE, self.DEDUP_TTL)
+        self.on_done = None                 # called with every accepted update once handled or dropped
+        self.stats = {"received": 0, "dispatched": 0, "dropped": 0, "duplicates": 0, "preempted": 0,
+                      "max_depth": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"dispatch-{i}", daemon=True).start()
+
+    def submit(self, update):
+        chat_id = update_chat_id(update)
+        cb_id = update.get("callback_query", {}).get("id")
+        with self._cond:
+            self.stats["received"] += 1
+            if (self._recent.check(("update", update.get("update_id")))
+                    or cb_id and self._recent.check(("callback", cb_id))):
+                self.stats["duplicates"] += 1
+                _metrics.inc("updates_duplicate_total")
+                print(f"Dispatch: duplicate update {update.get('update_id')} dropped")
+                self._done(update)
+                return True
+            if is_stop_command(update):
+                queued = self._queues.pop(chat_id, None) or ()
+                if queued:
+                    self._depth -= len(queued)
+                    self.stats["preempted"] += len(queued)
+                    if chat_id in self._ready:
+                        self._ready.remove(chat_id)
+                threading.Thread(target=self._preempt, args=(update, queued), daemon=True).start()
+                return True
+            if self._depth >= self.MAX_QUEUED:
+                self.stats["dropped"] += 1
+                # Not taken: a redelivery of it must not count as a duplicate
+                self._recent.forget(("update", update.get("update_id")))
+                if cb_id:
+                    self._recent.forget(("callback", cb_id))
+                print(f"Dispatch: queue full, dropped update {update.get('update_id')}")
+                return False
+            queue = self._queues.setdefault(chat_id, collections.deque())
+            queue.append((time.time(), update))
+            self._depth += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self._depth)
+            if chat_id not in self._busy and chat_id not in self._ready:
+                self._ready.append(chat_id)
+                self._cond.notify()
+        return True
+
+    def depth(self):
+        with self._cond:
+            return self._depth
+
+    def snapshot(self):
+        with self._cond:
+            stats = dict(self.stats, depth=self._depth, busy=len(self._busy), recent_ids=len(self._recent))
+        n = stats["dispatched"]
+        stats["latency_avg"] = stats["latency_total"] / n if n else 0.0
+        return stats
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                chat_id = self._ready.popleft()
+                enqueued, update = self._queues[chat_id].popleft()
+                if not self._queues[chat_id]:
+                    del self._queues[chat_id]
+                self._depth -= 1
+                self._busy.add(chat_id)
+            self._run(enqueued, update)
+            with self._cond:
+                self._busy.discard(chat_id)
+                if self._queues.get(chat_id):
+                    self._ready.append(chat_id)
+                    self._cond.notify()
+
+    def _preempt(self, update, queued):
+        for _, dropped in queued:
+            self._done(dropped)
+        self._run(time.time(), update)
+        if queued:
+            n = len(queued)
+            msg = update.get("message", {})
+            thread_id = msg.get("message_thread_id") if msg.get("is_topic_message") else None
+            self.bot.reply(msg.get("chat", {}).get("id"),
+                           f"Dropped {n} queued message{'s' if n != 1 else ''}", thread_id)
+
+    def _done(self, update):
+        if self.on_done:
+            self.on_done(update)
+
+    def _run(self, enqueued, update):
+        latency = time.time() - enqueued
+        with self._cond:
+            self.stats["dispatched"] += 1
+            self.stats["latency_total"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+        try:
+            self.bot.handle_update(update)
+        finally:
+            self._done(update)
+
+
+_dispatcher = UpdateDispatcher(Bot())
+_metrics.gauge("dispatch_queue_depth", "Incoming updates waiting for a worker", fn=_dispatcher.depth)
+
+
+class UpdatePoller(threading.Thread):
+    """Receives updates by long-polling getUpdates instead of a webhook."""
+    daemon = True
+
+    POLL_TIMEOUT = 50     # seconds Telegram holds an empty poll open
+    LIMIT = 100
+    MAX_BACKOFF = 30
+    ALLOWED_UPDATES = ["message", "callback_query"]
+
+    def __init__(self, dispatcher, offset_file=UPDATES_OFFSET_FILE):
+        super().__init__(name="updates")
+        self.dispatcher = dispatcher
+        self.offset_file = offset_file
+        self._client = TelegramClient(size=1)
+        self.offset = self._load_offset()
+        self._lock = threading.Lock()
+        self._unhandled = set()   # update_ids accepted by the dispatcher, not yet handled
+        dispatcher.on_done = self._handled
+        self.stats = {"polls": 0, "updates": 0, "errors": 0, "rejected": 0}
+
+    def _load_offset(self):
+        try:
+            with open(self.offset_file) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _save_offset(self):
+        with self._lock:
+            offset = min(self._unhandled, default=self.offset)
+        try:
+            with open(self.offset_file + ".tmp", "w") as f:
+                f.write(str(offset))
+            os.replace(self.offset_file + ".tmp", self.offset_file)
+        except OSError as e:
+            print(f"Updates: cannot save offset: {e}")
+
+    def run(self):
+        # getUpdates is refused while a webhook is set
+        _api_call("deleteWebhook", {})
+        print(f"Updates: long polling (offset {self.offset})")
+        backoff = 1
+        while True:
+            try:
+                delay = self.poll()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Updates: {e}")
+                delay = backoff
+            if delay:
+                backoff = min(backoff * 2, self.MAX_BACKOFF)
+                time.sleep(delay)
+            else:
+                backoff = 1
+
+    def poll(self):
+        """One getUpdates round trip. Returns seconds to wait before the next one."""
+        data = {"timeout": self.POLL_TIMEOUT, "limit": self.LIMIT,
+                "allowed_updates": self.ALLOWED_UPDATES}
+        if self.offset:
+            data["offset"] = self.offset
+        status, result = self._client.call("getUpdates", data, timeout=self.POLL_TIMEOUT + 10)
+        self.stats["polls"] += 1
+        if status != 200 or not result or not result.get("ok"):
+            self.stats["errors"] += 1
+            retry_after = ((result or {}).get("parameters") or {}).get("retry_after")
+            print(f"Updates: getUpdates failed ({status}): {(result or {}).get('description')}")
+            if status == 409:
+                _api_call("deleteWebhook", {})  # Someone set a webhook again
+            return retry_after or 1
+        for update in result.get("result") or []:
+            update_id = update.get("update_id", 0)
+            # Registered first: a worker may finish it before submit returns
+            with self._lock:
+                self._unhandled.add(update_id)
+            if not self.dispatcher.submit(update):
+                # Queue full: leave the offset here so Telegram sends it again
+                with self._lock:
+                    self._unhandled.discard(update_id)
+                self.stats["rejected"] += 1
+                return 1
+            self.stats["updates"] += 1
+            with self._lock:
+                self.offset = max(self.offset, update_id + 1)
+        return 0
+
+    def _handled(self, update):
+        with self._lock:
+            self._unhandled.discard(update.get("update_id", 0))
+        self._save_offset()
+
+
+_poller = UpdatePoller(_dispatcher) if UPDATES_MODE == "poll" else None
+
+
+def bridge_stats():
+    """Snapshot of the bridge's internal counters."""
+    stats = {
+        "telegram": dict(_telegram.stats),
+        "outbox": dict(_outbox.stats, depth=_outbox.depth()),
+        "dispatch": _dispatcher.snapshot(),
+        "state": dict(_state.stats),
+        "processes": dict(_processes.stats),
+        "search": dict(_search.stats),
+        "usage": dict(_usage.stats),
+    }
+    if _poller:
+        stats["updates"] = dict(_poller.stats, offset=_poller.offset)
+    return stats
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Webhook endpoint: validate, acknowledge at once, dispatch in the background."""
+
+    MAX_BODY = 1 << 20
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self._respond(411, b"Length Required")
+        if not 0 < length <= self.MAX_BODY:
+            return self._respond(413, b"Payload Too Large")
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+                self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return self._respond(403, b"Forbidden")
+        body = self.rfile.read(length)
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return self._respond(400, b"Bad Request")
+        if not isinstance(update, dict) or "update_id" not in update:
+            return self._respond(400, b"Bad Request")
+        self._respond(200, b"OK")
+        _dispatcher.submit(update)
+
+    def _internal(self):
+        """Loopback clients not forwarded by the tunnel (cloudflared connects from localhost too), or METRICS_TOKEN."""
+        if METRICS_TOKEN and hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            return True
+        forwarded = any(self.headers.get(h) for h in ("Cf-Connecting-Ip", "Cf-Ray", "X-Forwarded-For"))
+        return self.client_address[0] in ("127.0.0.1", "::1") and not forwarded
+
+    def do_GET(self):
+        if self.path in ("/stats", "/metrics") and not self._internal():
+            return self._respond(404, b"Not Found")
+        if self.path == "/stats":
+            return self._respond(200, json.dumps(bridge_stats()).encode(), "application/json")
+        if self.path == "/metrics":
+            return self._respond(200, _metrics.render().encode(), "text/plain; version=0.0.4")
+        self._respond(200, b"Claude-Telegram Bridge")
+
+    def _respond(self, code, body, content_type="text/plain"):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def log_message(self, *args):
         pass
 
 
+def warm_search_index():
+    started = time.monotonic()
+    try:
+        read = _search.update()
+    except sqlite3.Error as e:
+        print(f"Search index: {e}")
+        return
+    if read:
+        print(f"Search index: {read >> 20} MB indexed in {time.monotonic() - started:.1f}s")
+
+
 def main():
     if not BOT_TOKEN:
         print("Error: TELEGRAM_BOT_TOKEN not set")
         return
     setup_bot_commands()
-    PaneWatcher().start()
-    print(f"Bridge on :{PORT} | tmux: {TMUX_SESSION}")
+    _pane_classifier.load()
+    _state.start()
+    _outbox.start()
+    _dispatcher.start()
+    WatcherLoop(_sessions).start()
+    hook_socket = HookSocket(_sessions)
+    hook_socket.start()
+    if _poller:
+        _poller.start()
+    # Build or catch up the /search index now, so the first query only reads new records
+    threading.Thread(target=warm_search_index, name="search-index", daemon=True).start()
+    print(f"Bridge on :{PORT} | tmux: {TMUX_SESSIONS} | updates: {UPDATES_MODE}")
+    if UPDATES_MODE == "webhook" and not WEBHOOK_SECRET:
+        print("Warning: WEBHOOK_SECRET not set; the webhook accepts updates from anyone")
+    # run.sh stops the bridge with SIGTERM; exit through the cleanup below
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     try:
-        HTTPServer(("0.0.0.0", PORT), Handler).serve_forever()
-    except KeyboardInterrupt:
+        ThreadingHTTPServer(("0.0.0.0", PORT), Handler).serve_forever()
+    except (KeyboardInterrupt, SystemExit):
         print("\nStopped")
+    finally:
+        hook_socket.close()
+        _state.flush()
+        _usage.save(force=True)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,32 @@
 #!/bin/bash
-# PostToolUse hook — save transcript path for the Telegram bridge watcher.
-# Scoped to tmux "claude" session only. Lightweight: just writes one line.
+# PostToolUse hook — tell the Telegram bridge watcher about tool use and the transcript path.
+# Scoped to the tmux sessions the bridge serves. Lightweight: just writes one line.
 #
 # Install: cp hooks/save-transcript-path.sh ~/.claude/hooks/
 #          chmod +x ~/.claude/hooks/save-transcript-path.sh
 
 [ -z "$TMUX" ] && exit 0
-CURRENT_SESSION=$(tmux display-message -p '#S' 2>/dev/null)
-[ "$CURRENT_SESSION" != "claude" ] && exit 0
+IFS= read -r -d '' INPUT
+
+# Fast path: one write to the bridge's event socket; it maps the pane to
+# its session itself, so no tmux or jq here.
+SOCK=~/.claude/telegram_bridge.sock
+if [ -S "$SOCK" ] && command -v nc > /dev/null; then
+    LC_ALL=C   # byte length below
+    printf 'tool %s %d\n%s' "$TMUX_PANE" "${#INPUT}" "$INPUT" | nc -U -w 1 "$SOCK" > /dev/null 2>&1 && exit 0
+fi
+
+# Fallback: file protocol
+CURRENT_SESSION=$(tmux display-message -t "$TMUX_PANE" -p '#S' 2>/dev/null)
+# Bridged sessions are listed by the bridge; "claude" before it has started
+if [ -f ~/.claude/telegram_sessions ]; then
+    grep -qxF -- "$CURRENT_SESSION" ~/.claude/telegram_sessions || exit 0
+else
+    [ "$CURRENT_SESSION" != "claude" ] && exit 0
+fi
+SUFFIX=$(printf '%s' "$CURRENT_SESSION" | tr -c 'A-Za-z0-9_-' '_')
 
-INPUT=$(cat)
 TRANSCRIPT_PATH=$(echo "$INPUT" | jq -r '.transcript_path // empty')
 [ -n "$TRANSCRIPT_PATH" ] && [ -f "$TRANSCRIPT_PATH" ] && \
-    echo "$TRANSCRIPT_PATH" > ~/.claude/telegram_transcript_path
+    echo "$TRANSCRIPT_PATH" > ~/.claude/telegram_transcript_path."$SUFFIX"
 exit 0
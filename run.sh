@@ -5,9 +5,11 @@ PROJECT_DIR="$(cd "$(dirname "$0")" && pwd)"
 BOT_TOKEN="${TELEGRAM_BOT_TOKEN:-YOUR_BOT_TOKEN_HERE}"
 TMUX_SESSION="${TMUX_SESSION:-claude}"
 PORT="${PORT:-8080}"
+UPDATES_MODE="${UPDATES_MODE:-webhook}"
 BRIDGE_PID_FILE="$PROJECT_DIR/.bridge.pid"
 TUNNEL_PID_FILE="$PROJECT_DIR/.tunnel.pid"
 TUNNEL_LOG="$PROJECT_DIR/.tunnel.log"
+WEBHOOK_SECRET_FILE="$PROJECT_DIR/.webhook_secret"
 
 RED='\033[0;31m'
 GREEN='\033[0;32m'
@@ -78,12 +80,20 @@ with open(path, 'w') as f: json.dump(cfg, f, indent=2)
         fi
     fi
 
+    # Webhook secret: Telegram echoes it on every update, the bridge rejects requests without it
+    if [ -z "$WEBHOOK_SECRET" ]; then
+        if [ ! -s "$WEBHOOK_SECRET_FILE" ]; then
+            (umask 077 && head -c 32 /dev/urandom | od -An -tx1 | tr -d ' \n' > "$WEBHOOK_SECRET_FILE")
+        fi
+        WEBHOOK_SECRET="$(cat "$WEBHOOK_SECRET_FILE")"
+    fi
+
     # 2. Bridge server
     if [ -f "$BRIDGE_PID_FILE" ] && kill -0 "$(cat "$BRIDGE_PID_FILE")" 2>/dev/null; then
         log_ok "Bridge already running (PID: $(cat "$BRIDGE_PID_FILE"))"
     else
         cd "$PROJECT_DIR"
-        TELEGRAM_BOT_TOKEN="$BOT_TOKEN" "$PROJECT_DIR/.venv/bin/python" bridge.py &
+        TELEGRAM_BOT_TOKEN="$BOT_TOKEN" UPDATES_MODE="$UPDATES_MODE" WEBHOOK_SECRET="$WEBHOOK_SECRET" "$PROJECT_DIR/.venv/bin/python" bridge.py &
         BRIDGE_PID=$!
         echo "$BRIDGE_PID" > "$BRIDGE_PID_FILE"
         sleep 2
@@ -96,8 +106,10 @@ with open(path, 'w') as f: json.dump(cfg, f, indent=2)
         fi
     fi
 
-    # 3. Cloudflare Tunnel (bypass proxy for QUIC)
-    if [ -f "$TUNNEL_PID_FILE" ] && kill -0 "$(cat "$TUNNEL_PID_FILE")" 2>/dev/null; then
+    # 3. Cloudflare Tunnel (bypass proxy for QUIC) — not needed when long polling
+    if [ "$UPDATES_MODE" = "poll" ]; then
+        log_ok "Long polling getUpdates (no tunnel or webhook)"
+    elif [ -f "$TUNNEL_PID_FILE" ] && kill -0 "$(cat "$TUNNEL_PID_FILE")" 2>/dev/null; then
         log_ok "Tunnel already running (PID: $(cat "$TUNNEL_PID_FILE"))"
         TUNNEL_URL=$(grep -o 'https://[a-z0-9-]*\.trycloudflare\.com' "$TUNNEL_LOG" | head -1)
     else
@@ -129,7 +141,7 @@ with open(path, 'w') as f: json.dump(cfg, f, indent=2)
     # 4. Set webhook
     if [ -n "$TUNNEL_URL" ]; then
         sleep 2
-        RESULT=$(curl -s --max-time 10 "https://api.telegram.org/bot${BOT_TOKEN}/setWebhook?url=${TUNNEL_URL}")
+        RESULT=$(curl -s --max-time 10 "https://api.telegram.org/bot${BOT_TOKEN}/setWebhook?url=${TUNNEL_URL}&secret_token=${WEBHOOK_SECRET}")
         if echo "$RESULT" | grep -q '"ok":true'; then
             log_ok "Webhook set: $TUNNEL_URL"
         else
@@ -171,7 +183,7 @@ stop() {
         log_warn "Bridge not running"
     fi
 
-    rm -f ~/.claude/telegram_pending
+    rm -f ~/.claude/telegram_bridge.sock
 
     echo ""
     echo "========== Stopped =========="